@@ -0,0 +1,367 @@
+"""Load tests and benchmarks for the Plant routes
+
+Generates synthetic users and a plants/ tree, drives a weighted mix of
+requests through the Flask test client or against a locally launched server,
+and reports p50/p95/p99 latency and throughput per route.
+
+    python bench.py --users 10000 --plants 100000 --requests 20000 --save baseline.json
+    python bench.py --mode server --workers 4 --compare baseline.json --threshold 0.2
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'benchpass'
+DEFAULT_MIX = 'view_plant=50,serve_plant_file=30,login=5,upload_file=5,files=10'
+
+INDEX_HTML = '''<!DOCTYPE html>
+<html><head><title>{name}</title><link rel="stylesheet" href="style.css"></head>
+<body><h1>{name} 🌱</h1>{body}</body></html>
+'''
+
+def generate_data(data_dir, users, plants, seed=0):
+    """Fill the user store and a plants/ tree with a few assets per plant, run from inside data_dir"""
+    rng = random.Random(seed)
+    marker = os.path.join(data_dir, 'bench.json')
+    config = {'users': users, 'plants': plants, 'seed': seed}
+    if os.path.exists(marker):
+        with open(marker, 'r') as f:
+            if json.load(f) == config:
+                print(f'Reusing data in {data_dir}')
+                return
+        raise SystemExit(f'{data_dir} holds data for a different configuration, pick another --data-dir')
+
+    import main as plant
+
+    # One real hash shared by every user, hashing thousands of passwords would take minutes
+    password_hash = plant.current_hasher().hash(PASSWORD)
+    plant.user_store.put_many({f'user{i}': {'password': password_hash, 'created': '2024-01-01T00:00:00'}
+                               for i in range(users)})
+
+    css = 'body { font-family: Arial, sans-serif; color: #333; }\n' * 40
+    logo = bytes(rng.getrandbits(8) for _ in range(32 * 1024))
+    for j in range(plants):
+        plant_path = os.path.join(data_dir, 'plants', f'plant{j}')
+        os.makedirs(plant_path, exist_ok=True)
+        with open(os.path.join(plant_path, 'user.json'), 'w') as f:
+            json.dump({'owner': f'user{j % users}', 'created': '2024-01-01T00:00:00',
+                       'last_modified': '2024-01-01T00:00:00'}, f)
+        with open(os.path.join(plant_path, 'index.html'), 'w') as f:
+            f.write(INDEX_HTML.format(name=f'plant{j}', body='<p>Growing with love.</p>' * rng.randint(10, 200)))
+        with open(os.path.join(plant_path, 'style.css'), 'w') as f:
+            f.write(css)
+        with open(os.path.join(plant_path, 'logo.png'), 'wb') as f:
+            f.write(logo)
+        if j and j % 10000 == 0:
+            print(f'Generated {j} plants')
+
+    with open(marker, 'w') as f:
+        json.dump(config, f)
+
+def make_zip(size_mb, members):
+    """A zip of a few large members adding up to about size_mb
+
+    Half of each member is random bytes, like the images of a real site, so the
+    archive stays far below Plant's compression ratio limit.
+    """
+    buffer = io.BytesIO()
+    member_size = max(int(size_mb * 1024 * 1024) // members, 1)
+    text = ('<p>Plant with love 🌱</p>\n' * (member_size // 60 + 1)).encode('utf-8')[:member_size // 2]
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i in range(members):
+            zf.writestr(f'site/asset{i}.bin', text + os.urandom(member_size - len(text)))
+    return buffer.getvalue()
+
+def zip_limits(size_mb, members, concurrency):
+    """Plant limits the upload_zip archives need, every client may be replacing a folder at once"""
+    size = int(size_mb * 1024 * 1024)
+    room = size * 2 * (concurrency + 1)
+    return {'ZIP_MAX_TOTAL_SIZE': size * 2, 'ZIP_MAX_FILES': members * 2,
+            'QUOTA_PLANT_BYTES': room, 'QUOTA_USER_BYTES': room}
+
+def raise_limits(plant, limits):
+    """Raise Plant's limits to at least the given values, defaults that are higher are kept"""
+    for name, value in limits.items():
+        setattr(plant, name, max(getattr(plant, name), value))
+
+def create_app():
+    """The Plant app with the limits in PLANT_BENCH_LIMITS raised, for `flask --app 'bench:create_app()'`"""
+    import main as plant
+    raise_limits(plant, json.loads(os.environ.get('PLANT_BENCH_LIMITS', '{}')))
+    return plant.app
+
+class TestClientSession:
+    """Sends requests through the Flask test client"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json_body=None, files=None):
+        data = {'file': (io.BytesIO(files[1]), files[0])} if files else None
+        response = self.client.open(path, method=method, json=json_body, data=data)
+        response.close()
+        return response.status_code
+
+class HttpSession:
+    """Sends requests to a running server over one keep-alive connection"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookie = None
+        self.conn = http.client.HTTPConnection(host, port, timeout=300)
+
+    def request(self, method, path, json_body=None, files=None):
+        headers = {}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif files:
+            boundary = uuid.uuid4().hex
+            body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{files[0]}"\r\n'
+                    f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8') + files[1] + \
+                f'\r\n--{boundary}--\r\n'.encode('utf-8')
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # The server may close idle keep-alive connections, retry once on a fresh one
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        response.read()
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status
+
+def make_operations(users, plants, zip_bytes):
+    """Each operation takes (session, rng, user index) and returns the response status"""
+    def owned_plant(rng, user):
+        return f'plant{user + users * rng.randrange(max(plants // users, 1))}'
+
+    return {
+        'view_plant': lambda s, rng, user: s.request('GET', f'/plant{rng.randrange(plants)}'),
+        'serve_plant_file': lambda s, rng, user: s.request(
+            'GET', f'/plant{rng.randrange(plants)}/{rng.choice(["style.css", "logo.png", "index.html"])}'),
+        'login': lambda s, rng, user: s.request(
+            'POST', '/login', json_body={'username': f'user{user}', 'password': PASSWORD}),
+        'upload_file': lambda s, rng, user: s.request(
+            'POST', f'/api/upload/{owned_plant(rng, user)}', files=(f'bench{rng.randrange(100)}.txt', b'x' * 4096)),
+        'upload_zip': lambda s, rng, user: s.request(
+            'POST', f'/api/upload/{owned_plant(rng, user)}', files=('benchsite.zip', zip_bytes)),
+        'files': lambda s, rng, user: s.request('GET', f'/api/files/{owned_plant(rng, user)}'),
+    }
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run_workload(make_session, operations, mix, requests, concurrency, users, plants, seed):
+    """Drive the mix with concurrent clients, returns {route: [(latency, status)]}"""
+    names = [name for name in mix if mix[name] > 0]
+    unknown = set(names) - set(operations)
+    if unknown:
+        raise SystemExit(f'Unknown routes in --mix: {", ".join(sorted(unknown))}')
+    weights = [mix[name] for name in names]
+    results = {name: [] for name in names}
+    lock = threading.Lock()
+    per_client = requests // concurrency
+
+    def client(index):
+        rng = random.Random(seed + index)
+        user = index % min(users, plants)
+        session = make_session()
+        session.request('POST', '/login', json_body={'username': f'user{user}', 'password': PASSWORD})
+        local = {name: [] for name in names}
+        for _ in range(per_client):
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            status = operations[name](session, rng, user)
+            local[name].append((time.perf_counter() - start, status))
+        with lock:
+            for name, samples in local.items():
+                results[name].extend(samples)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    return results, time.perf_counter() - start
+
+def summarize(results, elapsed):
+    routes = {}
+    for name, samples in sorted(results.items()):
+        latencies = [latency for latency, _ in samples]
+        routes[name] = {
+            'count': len(samples),
+            'errors': sum(1 for _, status in samples if status >= 400),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'throughput': len(samples) / elapsed if elapsed else 0,
+        }
+    total = sum(r['count'] for r in routes.values())
+    return {'elapsed': elapsed, 'throughput': total / elapsed if elapsed else 0, 'routes': routes}
+
+def print_report(report):
+    print(f'\n{"route":<18} {"count":>8} {"errors":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"req/s":>9}')
+    for name, r in report['routes'].items():
+        if not r['count']:
+            continue
+        print(f'{name:<18} {r["count"]:>8} {r["errors"]:>7} {r["p50"] * 1000:>9.2f} {r["p95"] * 1000:>9.2f} '
+              f'{r["p99"] * 1000:>9.2f} {r["throughput"]:>9.1f}')
+    print(f'\nTotal {report["throughput"]:.1f} req/s over {report["elapsed"]:.1f}s')
+
+def compare(report, baseline, threshold):
+    """Regressions of p95 latency, throughput or error rate past the threshold, as messages"""
+    regressions = []
+    for name, base in baseline['routes'].items():
+        current = report['routes'].get(name)
+        if not current or not current['count'] or not base['count']:
+            continue
+        if current['p95'] > base['p95'] * (1 + threshold):
+            regressions.append(f'{name}: p95 {base["p95"] * 1000:.2f}ms -> {current["p95"] * 1000:.2f}ms')
+        if current['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append(f'{name}: {base["throughput"]:.1f} -> {current["throughput"]:.1f} req/s')
+        # A baseline without errors allows none, fast failures must not pass as a speedup
+        base_rate = base['errors'] / base['count']
+        current_rate = current['errors'] / current['count']
+        if current_rate > base_rate * (1 + threshold):
+            regressions.append(f'{name}: errors {base_rate:.2%} -> {current_rate:.2%}')
+    return regressions
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(data_dir, args, limits):
+    """Launch Plant in a subprocess with the given limits raised and wait until it accepts connections"""
+    port = free_port()
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'flask', '--app', 'bench:create_app()', 'serve', '--bind', f'127.0.0.1:{port}',
+                   '--workers', str(args.workers), '--threads', str(args.threads)]
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'bench:create_app()', 'run', '--port', str(port),
+                   '--with-threads']
+    env = dict(os.environ, PLANT_BENCH_LIMITS=json.dumps(limits),
+               PYTHONPATH=os.pathsep.join(filter(None, [HERE, os.environ.get('PYTHONPATH')])))
+    process = subprocess.Popen(command, cwd=data_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'Server exited early: {" ".join(command)}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('Server did not start in time')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', default='bench-data', help='Where the synthetic users and plants live')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--plants', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5000, help='Total requests across all clients')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Route weights, e.g. view_plant=50,login=5')
+    parser.add_argument('--zip-mb', type=float, default=1, help='Size of archives used by upload_zip')
+    parser.add_argument('--zip-members', type=int, default=4, help='Files in archives used by upload_zip')
+    parser.add_argument('--mode', choices=['client', 'server'], default='client',
+                        help='Flask test client in this process, or HTTP against a launched server')
+    parser.add_argument('--server', choices=['gunicorn', 'dev'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate-limits', action='store_true', help='Keep Plant\'s rate limits on while benchmarking')
+    parser.add_argument('--save', help='Write the report as a JSON baseline')
+    parser.add_argument('--compare', help='Baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed regression, 0.2 means 20%%')
+    args = parser.parse_args()
+
+    # Every client comes from 127.0.0.1, so per-IP limits would measure only 429s
+    if not args.rate_limits:
+        os.environ['PLANT_RATE_LIMITS'] = '0'
+
+    # main.py works relative to the current directory
+    data_dir = os.path.abspath(args.data_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    os.chdir(data_dir)
+    sys.path.insert(0, HERE)
+    generate_data(data_dir, args.users, args.plants, args.seed)
+    mix = parse_mix(args.mix)
+    zip_bytes = make_zip(args.zip_mb, args.zip_members) if mix.get('upload_zip') else b''
+    operations = make_operations(args.users, args.plants, zip_bytes)
+
+    # Big archives would only measure 413s against the default zip and quota limits
+    limits = zip_limits(args.zip_mb, args.zip_members, args.concurrency) if mix.get('upload_zip') else {}
+
+    process = None
+    if args.mode == 'server':
+        process, port = start_server(data_dir, args, limits)
+        make_session = lambda: HttpSession('127.0.0.1', port)
+    else:
+        import main as plant
+        raise_limits(plant, limits)
+        make_session = lambda: TestClientSession(plant.app)
+
+    try:
+        results, elapsed = run_workload(make_session, operations, mix, args.requests, args.concurrency,
+                                        args.users, args.plants, args.seed)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = summarize(results, elapsed)
+    report['config'] = {k: v for k, v in vars(args).items() if k not in ('save', 'compare')}
+    report['config']['raised_limits'] = limits
+    print_report(report)
+    if limits:
+        print('Plant limits raised to at least: ' + ', '.join(f'{k}={v}' for k, v in limits.items()))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved baseline to {args.save}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print('\nRegressions:')
+            for message in regressions:
+                print(f'  {message}')
+            sys.exit(1)
+        print('\nNo regressions past the threshold')
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,48 @@
-from flask import Flask, render_template_string, request, jsonify, send_from_directory, abort, session, redirect, url_for
+from flask import Flask, Response, g, request, jsonify, send_from_directory, abort, session, redirect, url_for
+import click
 import os
 import json
 import datetime
+import time
 import hashlib
+import hmac
+import base64
 import shutil
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.exceptions import NotFound
+from werkzeug.middleware.proxy_fix import ProxyFix
+from markupsafe import escape
 import zipfile
-import tempfile
+import uuid
+import ctypes
+import gzip
+import mimetypes
+from urllib.parse import quote
+import sqlite3
+import threading
+import cProfile
+import pstats
+import sys
+import random
+import contextlib
+import errno
+import queue
+import re
+import html
+import math
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = 'YOUR_SECRET_KEY'
@@ -14,30 +50,1783 @@ app.secret_key = 'YOUR_SECRET_KEY'
 # Directories
 PLANTS_DIR = "plants"
 USERS_FILE = "users.json"
+USERS_DB = "users.db"
+CATALOG_DB = "catalog.db"
+
+# Password hashing, slow on purpose, so it runs on a small bounded pool
+PASSWORD_HASHER = "scrypt"
+PASSWORD_HASHER_PARAMS = {
+    'scrypt': {'n': 2 ** 14, 'r': 8, 'p': 1},
+    'pbkdf2_sha256': {'iterations': 600000},
+}
+PASSWORD_WORKERS = 4
+PASSWORD_QUEUE_LIMIT = 32
+
+# Metrics: latency histogram buckets (seconds), and where workers share their numbers
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_DIR = "metrics"
+METRICS_DUMP_INTERVAL = 5
+
+# Profiling: 1 in PROFILE_SAMPLE_RATE requests is profiled with cProfile (0 turns it off)
+# and, while profiling is on, any request slower than PROFILE_SLOW_SECONDS is saved as sampled stacks
+PROFILE_SAMPLE_RATE = int(os.environ.get('PLANT_PROFILE_RATE', 0))
+PROFILE_SLOW_SECONDS = float(os.environ.get('PLANT_PROFILE_SLOW', 1.0))
+PROFILE_DIR = "profiles"
+# Settings changed through /api/admin/profiling, shared by all workers and kept over restarts
+PROFILE_SETTINGS_FILE = "profiling.json"
+PROFILE_KEEP = 500
+PROFILE_INTERVAL = 0.005
+ADMIN_USERS = set(filter(None, os.environ.get('PLANT_ADMINS', '').split(',')))
+
+# Viewer mode: "srcdoc" embeds index.html into the page, "url" loads it into the iframe by URL
+VIEWER_MODE = "srcdoc"
+
+# Spread plants over PLANTS_DIR/.shards/ab/cd/<name> instead of one flat directory
+SHARDED_LAYOUT = False
+SHARDS_DIR = os.path.join(PLANTS_DIR, ".shards")
+
+# Caches
+VIEWER_CACHE_SIZE = 256
+
+# Browser cache lifetime (seconds) for plant files by extension, 0 means always revalidate
+CACHE_MAX_AGE = {
+    '.html': 0, '.htm': 0,
+    '.css': 3600, '.js': 3600,
+    '.png': 86400, '.jpg': 86400, '.jpeg': 86400, '.gif': 86400, '.webp': 86400,
+    '.svg': 86400, '.ico': 86400,
+    '.woff': 604800, '.woff2': 604800, '.ttf': 604800, '.otf': 604800,
+    '.mp4': 604800, '.webm': 604800, '.mp3': 604800, '.ogg': 604800, '.wav': 604800,
+}
+DEFAULT_CACHE_MAX_AGE = 300
+
+# Text files get .gz (and .br when brotli is installed) siblings written at upload time
+COMPRESSIBLE_EXTENSIONS = {'.html', '.htm', '.css', '.js', '.mjs', '.svg', '.json', '.txt', '.xml', '.map'}
+COMPRESSED_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Limits for zip uploads
+ZIP_MAX_TOTAL_SIZE = 512 * 1024 * 1024
+ZIP_MAX_FILES = 10000
+ZIP_MAX_RATIO = 100
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# Store identical files once in a content-addressed blob store and hardlink them into plants
+DEDUPLICATE_UPLOADS = False
+BLOBS_DIR = "blobs"
+
+# Deleted paths remembered for /api/files?since= delta queries
+MANIFEST_MAX_TOMBSTONES = 5000
+
+# Full-text search over the HTML and text files of every plant
+SEARCH_DB = "search.db"
+SEARCH_EXTENSIONS = {'.html', '.htm', '.txt', '.md'}
+SEARCH_MAX_FILE_SIZE = 2 * 1024 * 1024
+SEARCH_MAX_TERMS = 10
+
+# Disk quotas, None means unlimited
+QUOTA_PLANT_BYTES = 1024 * 1024 * 1024
+QUOTA_PLANT_FILES = 20000
+QUOTA_USER_BYTES = 5 * 1024 * 1024 * 1024
+QUOTA_USER_FILES = 100000
+
+# Background jobs (deletes, big zip extractions) are queued as files in JOBS_DIR
+JOBS_DIR = "jobs"
+JOB_WORKERS = 4
+JOB_RETENTION = 24 * 3600
+JOB_QUEUE_LIMIT = 1000
+ASYNC_EXTRACT_SIZE = 16 * 1024 * 1024
+
+# Per-plant lock files, so worker processes take turns on manifests and tree swaps
+LOCKS_DIR = "locks"
+
+# Zip extractions run inside requests at once, and how many more may wait for a turn
+EXTRACT_WORKERS = 2
+EXTRACT_QUEUE_LIMIT = 4
+
+# Token bucket rate limits per endpoint: (requests, seconds), kept for each client
+# IP and each signed in user. Set RATE_LIMIT_DB to a file to share buckets between
+# workers, and PLANT_RATE_LIMITS=0 to turn limits off, e.g. for load tests
+RATE_LIMITS = {
+    'login': (10, 60),
+    'register': (5, 300),
+    'upload_file': (120, 60),
+    'upload_batch': (30, 60),
+    'init_chunked_upload': (30, 60),
+    'start_sync': (10, 60),
+    'plant_event_stream': (30, 60),
+    'view_plant': (120, 60),
+}
+if os.environ.get('PLANT_RATE_LIMITS') == '0':
+    RATE_LIMITS = {}
+RATE_LIMIT_DB = None
+RATE_LIMIT_MAX_KEYS = 100000
+
+# How many reverse proxies sit in front of the app. Their X-Forwarded-For, -Proto and
+# -Host headers are trusted, so rate limits key on the real client IP instead of the
+# proxy's. Keep it 0 when clients connect directly, they could forge the headers
+TRUSTED_PROXIES = int(os.environ.get('PLANT_TRUSTED_PROXIES', 0))
+
+# Seconds between keep-alive comments on server-sent event streams, and between
+# checks of the manifest for changes made by other worker processes
+EVENTS_HEARTBEAT = 15
+EVENTS_POLL = 1
+
+# Each open event stream holds a server thread, so each worker only keeps this many
+# open, in total, per user and per plant, leaving the rest of its threads for pages
+EVENTS_MAX_STREAMS = 8
+EVENTS_MAX_PER_USER = 4
+EVENTS_MAX_PER_PLANT = 2
+
+# Threads used to write the files of a batch upload
+UPLOAD_WORKERS = 8
+
+# Chunked uploads, and how long an untouched upload or sync keeps its staging and quota
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_SIZE = 4 * 1024 * 1024 * 1024
+UPLOAD_STALE_AFTER = 24 * 3600
+
+# Let a front proxy stream plant files: None, "x-sendfile" or "x-accel-redirect",
+# the proxy's internal location for ACCEL_REDIRECT_PREFIX must point at PLANTS_DIR
+SENDFILE_MODE = None
+ACCEL_REDIRECT_PREFIX = "/_plants/"
+
+app.config['USE_X_SENDFILE'] = SENDFILE_MODE == 'x-sendfile'
 
 # Create directories if they don't exist
 if not os.path.exists(PLANTS_DIR):
     os.makedirs(PLANTS_DIR)
 
+def sharded_plant_dir(plant_name):
+    digest = hashlib.sha1(plant_name.encode('utf-8')).hexdigest()
+    return os.path.join(SHARDS_DIR, digest[:2], digest[2:4], plant_name)
+
+def plant_dir(plant_name):
+    """Where a plant lives on disk
+
+    Both layouts are checked so plants keep working while a migration is
+    moving them; new plants go wherever SHARDED_LAYOUT says.
+    """
+    flat = os.path.join(PLANTS_DIR, plant_name)
+    sharded = sharded_plant_dir(plant_name)
+    preferred, other = (sharded, flat) if SHARDED_LAYOUT else (flat, sharded)
+    if not os.path.isdir(preferred) and os.path.isdir(other):
+        return other
+    return preferred
+
+def is_valid_plant_name(plant_name):
+    """Names starting with a dot are reserved for internal folders like .shards"""
+    return bool(plant_name) and not plant_name.startswith('.')
+
+def iter_flat_plant_names():
+    with os.scandir(PLANTS_DIR) as it:
+        for entry in it:
+            if entry.is_dir() and is_valid_plant_name(entry.name):
+                yield entry.name
+
+def iter_plant_names():
+    """Names of all plants, in both the flat and the sharded layout"""
+    yield from iter_flat_plant_names()
+    if os.path.isdir(SHARDS_DIR):
+        for first in os.scandir(SHARDS_DIR):
+            for second in os.scandir(first.path):
+                for entry in os.scandir(second.path):
+                    if entry.is_dir() and is_valid_plant_name(entry.name):
+                        yield entry.name
+
+def migrate_plants(sharded=True, batch_size=500, pause=0.5, log=print):
+    """Move plants into (or out of) the sharded layout in batches while the app keeps serving
+
+    Each plant is moved with a single rename, so a request sees it either
+    in its old place or its new one; plant_dir() checks both.
+    """
+    if sharded:
+        names = list(iter_flat_plant_names())
+    else:
+        names = [n for n in iter_plant_names() if not os.path.isdir(os.path.join(PLANTS_DIR, n))]
+    moved = 0
+    for start in range(0, len(names), batch_size):
+        for plant_name in names[start:start + batch_size]:
+            flat = os.path.join(PLANTS_DIR, plant_name)
+            source, target = (flat, sharded_plant_dir(plant_name)) if sharded else (sharded_plant_dir(plant_name), flat)
+            if os.path.exists(target):
+                log(f'Skipping {plant_name}, {target} already exists')
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(source, target)
+            moved += 1
+        log(f'Moved {moved} of {len(names)} plants')
+        time.sleep(pause)
+    return moved
+
+class Metrics:
+    """Counters and latency histograms, rendered in the Prometheus text format
+
+    Every worker process keeps its own numbers and dumps them to METRICS_DIR,
+    /metrics adds up the dumps of all live workers.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._dumper_pid = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time an internal stage of a request"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('plant_stage_duration_seconds', time.perf_counter() - start, stage=stage)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), list(h)] for (name, labels), h in self.histograms.items()],
+            }
+
+    def _path(self, pid):
+        return os.path.join(METRICS_DIR, f'{pid}.json')
+
+    def dump(self):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = self._path(os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def start_dumper(self):
+        """Dump this worker's numbers every METRICS_DUMP_INTERVAL seconds"""
+        if self._dumper_pid == os.getpid():
+            return
+        self._dumper_pid = os.getpid()
+
+        def loop():
+            while True:
+                time.sleep(METRICS_DUMP_INTERVAL)
+                self.dump()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def collect(self):
+        """Add up the dumps of all live workers"""
+        self.dump()
+        counters, histograms = {}, {}
+        for name in os.listdir(METRICS_DIR):
+            if not name.endswith('.json'):
+                continue
+            pid = int(name[:-5])
+            if pid != os.getpid() and not pid_alive(pid):
+                os.remove(os.path.join(METRICS_DIR, name))
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, name), 'r') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric, labels, value in snapshot['counters']:
+                key = (metric, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for metric, labels, values in snapshot['histograms']:
+                key = (metric, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [0] * len(values))
+                histograms[key] = [a + b for a, b in zip(merged, values)]
+        return counters, histograms
+
+    def render(self, gauges=()):
+        counters, histograms = self.collect()
+        lines = []
+        typed = set()
+
+        def labels_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{labels_text(labels)} {value}')
+        for (name, labels), values in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{name}_bucket{labels_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{labels_text(labels, [("le", "+Inf")])} {values[-1]}')
+            lines.append(f'{name}_sum{labels_text(labels)} {values[-2]}')
+            lines.append(f'{name}_count{labels_text(labels)} {values[-1]}')
+        for name, value in gauges:
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(METRICS_BUCKETS)
+
+@app.before_request
+def start_request_timer():
+    metrics.start_dumper()
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    if 'request_start' in g:
+        metrics.observe('plant_request_duration_seconds', time.perf_counter() - g.request_start,
+                        endpoint=endpoint, method=request.method)
+    metrics.inc('plant_requests_total', endpoint=endpoint, status=response.status_code)
+    metrics.inc('plant_request_bytes_total', request.content_length or 0, endpoint=endpoint)
+    metrics.inc('plant_response_bytes_total', response.content_length or 0, endpoint=endpoint)
+    return response
+
+class StackSampler:
+    """Samples the stacks of registered request threads in the background"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._sampler_pid = None
+
+    def _start(self):
+        if self._sampler_pid == os.getpid():
+            return
+        self._sampler_pid = os.getpid()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._threads:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                        frame = frame.f_back
+                    key = ';'.join(reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+
+    def begin(self):
+        self._start()
+        with self._lock:
+            self._threads[threading.get_ident()] = {}
+
+    def end(self):
+        """Stop sampling this thread, returns {collapsed stack: samples}"""
+        with self._lock:
+            return self._threads.pop(threading.get_ident(), {})
+
+class RequestProfiler:
+    """Opt-in production profiling, writes tagged profiles to a rotating directory"""
+
+    def __init__(self):
+        self.sample_rate = PROFILE_SAMPLE_RATE
+        self.slow_seconds = PROFILE_SLOW_SECONDS
+        self.sampler = StackSampler(PROFILE_INTERVAL)
+        self._cprofile_lock = threading.Lock()
+        self._settings_mtime = None
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def refresh(self):
+        """Pick up settings another worker saved, checked by the file's mtime"""
+        try:
+            mtime = os.stat(PROFILE_SETTINGS_FILE).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._settings_mtime:
+            return
+        try:
+            with open(PROFILE_SETTINGS_FILE, 'r') as f:
+                settings = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.sample_rate = settings.get('sample_rate', self.sample_rate)
+        self.slow_seconds = settings.get('slow_seconds', self.slow_seconds)
+        self._settings_mtime = mtime
+
+    def configure(self, sample_rate, slow_seconds):
+        """Change the settings in every worker"""
+        tmp_path = hidden_tmp_path(PROFILE_SETTINGS_FILE)
+        with open(tmp_path, 'w') as f:
+            json.dump({'sample_rate': sample_rate, 'slow_seconds': slow_seconds}, f)
+        os.replace(tmp_path, PROFILE_SETTINGS_FILE)
+        self.refresh()
+
+    def begin(self):
+        self.refresh()
+        if not self.enabled:
+            return
+        g.profile_start = time.perf_counter()
+        # Only one cProfile can run at a time, busy means this request is just not picked
+        if random.randrange(self.sample_rate) == 0 and self._cprofile_lock.acquire(blocking=False):
+            g.cprofile = cProfile.Profile()
+            g.cprofile.enable()
+        else:
+            self.sampler.begin()
+
+    def end(self):
+        if 'profile_start' not in g:
+            return
+        duration = time.perf_counter() - g.pop('profile_start')
+        profile = g.pop('cprofile', None)
+        if profile is not None:
+            profile.disable()
+            self._cprofile_lock.release()
+            self._write(profile, duration)
+            return
+        stacks = self.sampler.end()
+        if duration >= self.slow_seconds and stacks:
+            self._write(stacks, duration)
+
+    def _write(self, profile, duration):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        plant_name = (request.view_args or {}).get('plant_name', '-')
+        tag = secure_filename(f'{request.endpoint}-{plant_name}') or 'unknown'
+        name = f'{time.time():.6f}-{tag}-{int(duration * 1000)}ms'
+        if isinstance(profile, cProfile.Profile):
+            profile.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
+        else:
+            with open(os.path.join(PROFILE_DIR, name + '.stacks'), 'w') as f:
+                f.writelines(f'{stack} {count}\n' for stack, count in profile.items())
+        self._rotate()
+
+    def _rotate(self):
+        names = sorted(os.listdir(PROFILE_DIR))
+        for name in names[:max(len(names) - PROFILE_KEEP, 0)]:
+            os.remove(os.path.join(PROFILE_DIR, name))
+
+profiler = RequestProfiler()
+
+@app.before_request
+def start_profiling():
+    profiler.begin()
+
+@app.teardown_request
+def stop_profiling(error=None):
+    profiler.end()
+
+def profile_report(paths, top=20):
+    """Aggregate saved profiles into the top functions, returns (cprofile rows, sampled rows)"""
+    stats = None
+    self_samples = {}
+    total_samples = 0
+    for path in paths:
+        if path.endswith('.prof'):
+            if stats is None:
+                stats = pstats.Stats(path)
+            else:
+                stats.add(path)
+        elif path.endswith('.stacks'):
+            with open(path, 'r') as f:
+                for line in f:
+                    stack, count = line.rsplit(' ', 1)
+                    leaf = stack.rsplit(';', 1)[-1]
+                    self_samples[leaf] = self_samples.get(leaf, 0) + int(count)
+                    total_samples += int(count)
+
+    cprofile_rows = []
+    if stats is not None:
+        # (primitive calls, total calls, own time, cumulative time, callers) per function
+        ordered = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        for (filename, line, func), (_, calls, own, cumulative, _) in ordered[:top]:
+            cprofile_rows.append((f'{os.path.basename(filename)}:{line}({func})', calls, own, cumulative))
+    sampled_rows = [(leaf, count, count / total_samples)
+                    for leaf, count in sorted(self_samples.items(), key=lambda item: item[1], reverse=True)[:top]]
+    return cprofile_rows, sampled_rows
+
+class UserStore:
+    """SQLite backed user store with one-time migration from users.json"""
+
+    def __init__(self, db_path, legacy_file=None):
+        self.db_path = db_path
+        self.legacy_file = legacy_file
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self._migrate()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _migrate(self):
+        """Import users.json once, then move it out of the way"""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return
+        with open(self.legacy_file, 'r') as f:
+            users = json.load(f)
+        with self._connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO users (username, data) VALUES (?, ?)',
+                             [(name, json.dumps(record)) for name, record in users.items()])
+        os.replace(self.legacy_file, self.legacy_file + '.migrated')
+
+    def get(self, username):
+        row = self._connect().execute('SELECT data FROM users WHERE username = ?', (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add(self, username, record):
+        """Insert a new user, returns False if the name is taken"""
+        try:
+            with self._connect() as conn:
+                conn.execute('INSERT INTO users (username, data) VALUES (?, ?)', (username, json.dumps(record)))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def put(self, username, record):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)', (username, json.dumps(record)))
+
+    def all(self):
+        rows = self._connect().execute('SELECT username, data FROM users').fetchall()
+        return {name: json.loads(data) for name, data in rows}
+
+    def put_many(self, users):
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)',
+                             [(name, json.dumps(record)) for name, record in users.items()])
+
+user_store = UserStore(USERS_DB, legacy_file=USERS_FILE)
+
 def load_users():
-    """Load users from JSON file"""
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+    """Load all users from the user store"""
+    return user_store.all()
 
 def save_users(users):
-    """Save users to JSON file"""
-    with open(USERS_FILE, 'w') as f:
-        json.dump(users, f, indent=2)
+    """Save users to the user store"""
+    user_store.put_many(users)
+
+def get_user(username):
+    """Get a single user record"""
+    with metrics.timer('user_store'):
+        return user_store.get(username)
+
+def add_user(username, record):
+    """Add a new user, False if the username already exists"""
+    with metrics.timer('user_store'):
+        return user_store.add(username, record)
+
+class PasswordHasher:
+    """One password hashing algorithm
+
+    Hashes are stored as "<name>$<params>$<salt>$<hash>" so every record
+    keeps the algorithm and cost it was made with.
+    """
+    name = None
+
+    def __init__(self, **params):
+        self.params = params
+
+    def encode(self, password, salt):
+        raise NotImplementedError
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        params = ','.join(f'{k}={v}' for k, v in sorted(self.params.items()))
+        digest = base64.b64encode(self.encode(password, salt)).decode()
+        return f'{self.name}${params}${base64.b64encode(salt).decode()}${digest}'
+
+class ScryptHasher(PasswordHasher):
+    name = 'scrypt'
+
+    def encode(self, password, salt):
+        return hashlib.scrypt(password.encode(), salt=salt, n=self.params['n'], r=self.params['r'],
+                              p=self.params['p'], maxmem=256 * self.params['n'] * self.params['r'])
+
+class Pbkdf2Hasher(PasswordHasher):
+    name = 'pbkdf2_sha256'
+
+    def encode(self, password, salt):
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, self.params['iterations'])
+
+PASSWORD_HASHERS = {
+    'scrypt': ScryptHasher,
+    'pbkdf2_sha256': Pbkdf2Hasher,
+}
+
+def current_hasher():
+    return PASSWORD_HASHERS[PASSWORD_HASHER](**PASSWORD_HASHER_PARAMS[PASSWORD_HASHER])
 
 def hash_password(password):
     """Hash password with love"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    with metrics.timer('password_hash'):
+        return current_hasher().hash(password)
+
+def parse_password_hash(stored):
+    """Split a stored hash into (algorithm, params, salt, digest), legacy hashes are plain SHA-256 hex"""
+    if '$' not in stored:
+        return 'sha256', {}, b'', stored
+    name, params, salt, digest = stored.split('$')
+    params = {k: int(v) for k, v in (item.split('=') for item in params.split(',') if item)}
+    return name, params, base64.b64decode(salt), base64.b64decode(digest)
+
+def verify_password(password, stored):
+    with metrics.timer('password_hash'):
+        return _verify_password(password, stored)
+
+def _verify_password(password, stored):
+    name, params, salt, digest = parse_password_hash(stored)
+    if name == 'sha256':
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), digest)
+    return hmac.compare_digest(PASSWORD_HASHERS[name](**params).encode(password, salt), digest)
+
+def needs_rehash(stored):
+    """Whether a stored hash was made with an older algorithm or cost"""
+    name, params, _, _ = parse_password_hash(stored)
+    return name != PASSWORD_HASHER or params != PASSWORD_HASHER_PARAMS[PASSWORD_HASHER]
+
+class PoolBusy(Exception):
+    """Too much work is already queued"""
+
+class BoundedPool:
+    """Thread pool that refuses work instead of queueing it without limit"""
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def run(self, func, *args):
+        """Run func on the pool and wait for it, raises PoolBusy when the queue is full"""
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusy()
+        try:
+            return self._pool.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+password_pool = BoundedPool(PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT)
+extraction_pool = BoundedPool(EXTRACT_WORKERS, EXTRACT_QUEUE_LIMIT)
+
+def busy_response():
+    response = jsonify({'error': 'Plant is very busy right now, please try again in a moment! 🌱'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+class RateLimiter:
+    """Token buckets keyed by endpoint and client
+
+    Buckets are (tokens, last refill) tuples in an LRU-bounded dict, or rows
+    in a shared SQLite file when several workers must agree on the limits.
+    A bucket evicted from memory simply starts full again; rows are swept
+    once they are old enough to have refilled, which changes nothing either.
+    """
+
+    def __init__(self, limits, db_path=None, max_keys=100000):
+        self.limits = limits
+        self.db_path = db_path
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Any bucket untouched for the longest limit's window is full again
+        self._window = max((seconds for _, seconds in limits.values()), default=0)
+        self._next_sweep = 0
+        if db_path:
+            with self._connect() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                             'updated REAL NOT NULL) WITHOUT ROWID')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _refill(bucket, capacity, rate, now):
+        """Take a token from a bucket, returns (new bucket, seconds to wait or 0)"""
+        tokens, updated = bucket
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            return (tokens - 1, now), 0
+        return (tokens, now), (1 - tokens) / rate
+
+    def _take(self, key, capacity, rate, now):
+        if self.db_path:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                bucket, wait = self._refill(row or (capacity, now), capacity, rate, now)
+                conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (key,) + bucket)
+                if now >= self._next_sweep:
+                    self._next_sweep = now + self._window
+                    conn.execute('DELETE FROM buckets WHERE updated < ?', (now - self._window,))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            return wait
+        with self._lock:
+            bucket, wait = self._refill(self._buckets.pop(key, (capacity, now)), capacity, rate, now)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def hit(self, endpoint, clients):
+        """Count a request against each client's bucket, returns seconds to wait or 0 if allowed"""
+        requests, seconds = self.limits[endpoint]
+        now = time.time()
+        return max(self._take(f'{endpoint}:{client}', requests, requests / seconds, now) for client in clients)
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_DB, RATE_LIMIT_MAX_KEYS)
+
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES, x_host=TRUSTED_PROXIES)
+
+@app.before_request
+def enforce_rate_limits():
+    if request.endpoint not in rate_limiter.limits:
+        return None
+    clients = [f'ip:{request.remote_addr}']
+    if 'username' in session:
+        clients.append(f'user:{session["username"]}')
+    wait = rate_limiter.hit(request.endpoint, clients)
+    if not wait:
+        return None
+    metrics.inc('plant_rate_limited_total', endpoint=request.endpoint)
+    response = jsonify({'error': 'Whoa, slow down a little! Please try again in a moment 🌸'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response
+
+class PlantIndex:
+    """In-memory index of plant metadata (user.json), validated by mtime"""
+
+    def __init__(self):
+        self.generation = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _info_path(self, plant_name):
+        return os.path.join(plant_dir(plant_name), "user.json")
+
+    def _read(self, plant_name):
+        path = self._info_path(plant_name)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with open(path, 'r') as f:
+                return plant_name, mtime, json.load(f)
+        except (OSError, ValueError):
+            return plant_name, None, None
+
+    def build(self, workers=8):
+        """Scan PLANTS_DIR once, reading every user.json in parallel"""
+        names = list(iter_plant_names())
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(self._read, names))
+        with self._lock:
+            self._entries = {name: (mtime, info) for name, mtime, info in results if info is not None}
+            self.generation += 1
+
+    def get(self, plant_name):
+        """Get plant metadata, re-reading user.json only if it changed on disk"""
+        try:
+            mtime = os.stat(self._info_path(plant_name)).st_mtime_ns
+        except OSError:
+            with self._lock:
+                if self._entries.pop(plant_name, None) is not None:
+                    self.generation += 1
+            return None
+        cached = self._entries.get(plant_name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        _, mtime, info = self._read(plant_name)
+        if info is not None:
+            self.put(plant_name, info, mtime)
+        return info
+
+    def put(self, plant_name, info, mtime=None):
+        if mtime is None:
+            mtime = os.stat(self._info_path(plant_name)).st_mtime_ns
+        with self._lock:
+            self._entries[plant_name] = (mtime, info)
+            self.generation += 1
+
+plant_index = PlantIndex()
+plant_index.build()
+
+class PlantCatalog:
+    """SQLite directory of plants (owner, created, last_modified, files, bytes)
+
+    Written through on plant creation and on every manifest change, so plant
+    listings never have to walk PLANTS_DIR. Existing plants are added once
+    with `flask catalog-rebuild`. Per-owner totals live in their own table and
+    move by the same delta in the same transaction, which is what quotas read.
+    Uploads in flight hold reservations that quotas count as used until commit.
+    """
+
+    SORTS = {
+        'recent': 'last_modified DESC, name',
+        'created': 'created DESC, name',
+        'size': 'bytes DESC, name',
+        'name': 'name',
+    }
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS plants (name TEXT PRIMARY KEY, owner TEXT NOT NULL, '
+                         'created TEXT NOT NULL, last_modified TEXT NOT NULL, '
+                         'files INTEGER NOT NULL DEFAULT 0, bytes INTEGER NOT NULL DEFAULT 0)')
+            conn.execute('CREATE INDEX IF NOT EXISTS plants_recent ON plants (last_modified)')
+            conn.execute('CREATE INDEX IF NOT EXISTS plants_size ON plants (bytes)')
+            conn.execute('CREATE INDEX IF NOT EXISTS plants_owner ON plants (owner, last_modified)')
+            conn.execute('CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, '
+                         'files INTEGER NOT NULL DEFAULT 0, bytes INTEGER NOT NULL DEFAULT 0)')
+            conn.execute('CREATE TABLE IF NOT EXISTS reservations (key TEXT PRIMARY KEY, plant TEXT NOT NULL, '
+                         'owner TEXT NOT NULL, files INTEGER NOT NULL, bytes INTEGER NOT NULL, staging TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS reservations_plant ON reservations (plant)')
+            conn.execute('CREATE INDEX IF NOT EXISTS reservations_owner ON reservations (owner)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Take the write lock up front so read-then-update sees no other writer"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _count(self, conn, owner, files, size):
+        conn.execute('INSERT INTO owners (owner, files, bytes) VALUES (?, ?, ?) ON CONFLICT (owner) '
+                     'DO UPDATE SET files = files + excluded.files, bytes = bytes + excluded.bytes', (owner, files, size))
+
+    def add(self, plant_name, owner, created, last_modified=None, files=0, size=0):
+        with self._transaction() as conn:
+            old = conn.execute('SELECT owner, files, bytes FROM plants WHERE name = ?', (plant_name,)).fetchone()
+            if old:
+                self._count(conn, old[0], -old[1], -old[2])
+            conn.execute('INSERT OR REPLACE INTO plants (name, owner, created, last_modified, files, bytes) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (plant_name, owner, created, last_modified or created, files, size))
+            self._count(conn, owner, files, size)
+
+    def update(self, plant_name, files, size, last_modified=None):
+        """Set a plant's counters, moving its owner's totals by the difference"""
+        with self._transaction() as conn:
+            old = conn.execute('SELECT owner, files, bytes FROM plants WHERE name = ?', (plant_name,)).fetchone()
+            if old is None:
+                return
+            conn.execute('UPDATE plants SET files = ?, bytes = ?, last_modified = COALESCE(?, last_modified) '
+                         'WHERE name = ?', (files, size, last_modified, plant_name))
+            self._count(conn, old[0], files - old[1], size - old[2])
+
+    def _usage(self, conn, plant_name, reserved, exclude):
+        usage = conn.execute('SELECT p.owner, p.files, p.bytes, o.files, o.bytes FROM plants p '
+                             'JOIN owners o ON o.owner = p.owner WHERE p.name = ?', (plant_name,)).fetchone()
+        if usage is None or not reserved:
+            return usage
+        owner, plant_files, plant_bytes, owner_files, owner_bytes = usage
+        plant_held = conn.execute('SELECT COALESCE(SUM(files), 0), COALESCE(SUM(bytes), 0) FROM reservations '
+                                  'WHERE plant = ? AND key != ?', (plant_name, exclude or '')).fetchone()
+        owner_held = conn.execute('SELECT COALESCE(SUM(files), 0), COALESCE(SUM(bytes), 0) FROM reservations '
+                                  'WHERE owner = ? AND key != ?', (owner, exclude or '')).fetchone()
+        return (owner, plant_files + plant_held[0], plant_bytes + plant_held[1],
+                owner_files + owner_held[0], owner_bytes + owner_held[1])
+
+    def usage(self, plant_name, reserved=True, exclude=None):
+        """(owner, plant files, plant bytes, owner files, owner bytes), or None for unknown plants
+
+        Reservations count as used unless reserved is False, except the one named by exclude.
+        """
+        return self._usage(self._connect(), plant_name, reserved, exclude)
+
+    def reserve(self, key, plant_name, staging, size, files, check):
+        """Hold space for an upload in flight if check(usage) finds no error, in one transaction
+
+        Returns the error from check, or None once the space is held.
+        """
+        with self._transaction() as conn:
+            usage = self._usage(conn, plant_name, True, key)
+            if usage is None:
+                return None
+            error = check(usage)
+            if error is None:
+                conn.execute('INSERT OR REPLACE INTO reservations (key, plant, owner, files, bytes, staging) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (key, plant_name, usage[0], files, size, staging))
+            return error
+
+    def release(self, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM reservations WHERE key = ?', (key,))
+
+    def reservations(self):
+        """(key, plant, staging path inside the plant) of every reservation"""
+        return self._connect().execute('SELECT key, plant, staging FROM reservations').fetchall()
+
+    def recount_owners(self):
+        """Recompute owner totals from the plant rows"""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM owners')
+            conn.execute('INSERT INTO owners (owner, files, bytes) '
+                         'SELECT owner, SUM(files), SUM(bytes) FROM plants GROUP BY owner')
+
+    def list(self, owner=None, sort='recent', offset=0, limit=50):
+        """One page of plants, returns (total, plants)"""
+        where, args = ('WHERE owner = ?', (owner,)) if owner is not None else ('', ())
+        conn = self._connect()
+        with metrics.timer('catalog'):
+            total = conn.execute(f'SELECT COUNT(*) FROM plants {where}', args).fetchone()[0]
+            rows = conn.execute(f'SELECT name, owner, created, last_modified, files, bytes FROM plants {where} '
+                                f'ORDER BY {self.SORTS[sort]} LIMIT ? OFFSET ?', args + (limit, offset)).fetchall()
+        keys = ('name', 'owner', 'created', 'last_modified', 'files', 'bytes')
+        return total, [dict(zip(keys, row)) for row in rows]
+
+    def rebuild(self, log=print):
+        """Add every plant on disk, counting its files from the manifest"""
+        done = 0
+        for plant_name in iter_plant_names():
+            info = plant_index.get(plant_name)
+            if info is None:
+                continue
+            files = manifest_store.get(plant_name)['files']
+            self.add(plant_name, info.get('owner'), info.get('created', ''), info.get('last_modified'),
+                     len(files), sum(entry['size'] for entry in files.values()))
+            done += 1
+            if done % 1000 == 0:
+                log(f'Cataloged {done} plants')
+        log(f'Cataloged {done} plants 🌱')
+
+plant_catalog = PlantCatalog(CATALOG_DB)
+
+upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+
+class RenderCache:
+    """Bounded LRU cache for rendered pages"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+viewer_cache = RenderCache(VIEWER_CACHE_SIZE)
+
+def file_digest(path):
+    """SHA-256 of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hidden_tmp_path(path):
+    """A temp file next to path that manifest scans skip and no other writer shares"""
+    return os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}-{uuid.uuid4().hex}.tmp')
+
+@contextlib.contextmanager
+def file_lock(path, exclusive=True):
+    """Hold a flock on path against other processes, shared or exclusive (a no-op without fcntl)"""
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+class PlantLock:
+    """Re-entrant lock for one plant, held against the other worker processes too
+
+    Threads take turns on an RLock, the outermost holder also takes a flock
+    on the plant's lock file through a descriptor this process keeps open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def close(self):
+        """Drop the descriptor, a forked child must open its own to be locked out by its parent"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class PlantWriteLock:
+    """Lets any number of writes into a plant run together, or one sync swap the whole tree alone
+
+    Threads are sorted out here and other processes through a shared or
+    exclusive flock on path. A waiting swap holds back new writes of its own
+    process, so a busy plant cannot starve it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cond = threading.Condition()
+        self._writers = 0
+        self._swapping = False
+        self._waiting = 0
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            while self._swapping or self._waiting:
+                self._cond.wait()
+            self._writers += 1
+        try:
+            with file_lock(self.path, exclusive=False):
+                yield
+        finally:
+            with self._cond:
+                self._writers -= 1
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def swap(self):
+        with self._cond:
+            self._waiting += 1
+            while self._swapping or self._writers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._swapping = True
+        try:
+            with file_lock(self.path):
+                yield
+        finally:
+            with self._cond:
+                self._swapping = False
+                self._cond.notify_all()
+
+class ManifestStore:
+    """Per-plant manifest of files (path, size, mtime, sha256) kept in .manifest.json
+
+    Every change bumps the plant's generation, so clients can ask for the
+    changes since the generation they last saw instead of re-listing.
+    """
+
+    def __init__(self):
+        self._manifests = {}
+        self._locks = {}
+        self._write_locks = {}
+        self._lock = threading.Lock()
+
+    def _plant_lock(self, plant_name):
+        with self._lock:
+            if plant_name not in self._locks:
+                os.makedirs(LOCKS_DIR, exist_ok=True)
+                self._locks[plant_name] = PlantLock(os.path.join(LOCKS_DIR, f'{plant_name}.manifest.lock'))
+            return self._locks[plant_name]
+
+    def _write_lock(self, plant_name):
+        with self._lock:
+            if plant_name not in self._write_locks:
+                os.makedirs(LOCKS_DIR, exist_ok=True)
+                self._write_locks[plant_name] = PlantWriteLock(os.path.join(LOCKS_DIR, f'{plant_name}.write.lock'))
+            return self._write_locks[plant_name]
+
+    def writing(self, plant_name):
+        """Hold while writing files into a plant and updating its manifest"""
+        return self._write_lock(plant_name).write()
+
+    def swapping(self, plant_name):
+        """Hold while replacing a plant's whole tree, waits for every write to finish"""
+        return self._write_lock(plant_name).swap()
+
+    def _path(self, plant_name):
+        return os.path.join(plant_dir(plant_name), '.manifest.json')
+
+    def _scan(self, plant_path, rel=''):
+        """Yield relative paths of all plant files, skipping internal ones"""
+        with os.scandir(os.path.join(plant_path, rel)) as it:
+            for entry in it:
+                if entry.name.startswith('.') or (not rel and entry.name == 'user.json'):
+                    continue
+                path = f'{rel}/{entry.name}' if rel else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._scan(plant_path, path)
+                elif not is_compressed_variant(os.path.join(plant_path, rel), entry.name):
+                    yield path
+
+    def _entry(self, plant_name, path, generation):
+        full = os.path.join(plant_dir(plant_name), path)
+        stat = os.stat(full)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_digest(full), 'generation': generation}
+
+    def _build(self, plant_name):
+        """Build a manifest from scratch with os.scandir"""
+        plant_path = plant_dir(plant_name)
+        manifest = {'generation': 1, 'oldest_generation': 0, 'files': {}, 'deleted': {}}
+        if os.path.isdir(plant_path):
+            for path in self._scan(plant_path):
+                manifest['files'][path] = self._entry(plant_name, path, 1)
+        return manifest
+
+    def _save(self, plant_name, manifest):
+        path = self._path(plant_name)
+        if not os.path.isdir(os.path.dirname(path)):
+            return
+        tmp_path = hidden_tmp_path(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+        self._manifests[plant_name] = (os.stat(path).st_mtime_ns, manifest)
+
+    def get(self, plant_name):
+        """Get a plant's manifest, loading or building it if needed"""
+        with self._plant_lock(plant_name):
+            try:
+                mtime = os.stat(self._path(plant_name)).st_mtime_ns
+            except OSError:
+                manifest = self._build(plant_name)
+                self._save(plant_name, manifest)
+                return manifest
+            cached = self._manifests.get(plant_name)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            try:
+                with open(self._path(plant_name), 'r') as f:
+                    manifest = json.load(f)
+            except ValueError:
+                manifest = self._build(plant_name)
+                self._save(plant_name, manifest)
+                return manifest
+            self._manifests[plant_name] = (mtime, manifest)
+            return manifest
+
+    def update(self, plant_name, prefix):
+        """Re-read a file, or every file in a folder, after it was written"""
+        return self.apply(plant_name, changed=[prefix])
+
+    def remove(self, plant_name, prefix):
+        """Drop a file, or every file in a folder, from the manifest"""
+        return self.apply(plant_name, removed=[prefix])
+
+    def apply(self, plant_name, changed=(), removed=()):
+        """Re-read changed paths and drop removed ones as a single new generation"""
+        with self._plant_lock(plant_name):
+            manifest = self.get(plant_name)
+            generation = manifest['generation'] + 1
+            forgotten = {}
+            added, modified, touched = [], [], []
+            for prefix in removed:
+                forgotten.update(self._forget(manifest, prefix, generation))
+            for prefix in changed:
+                full = os.path.join(plant_dir(plant_name), prefix)
+                if os.path.isdir(full):
+                    paths = {f'{prefix}/{p}' for p in self._scan(full)}
+                else:
+                    paths = {prefix} if os.path.exists(full) else set()
+                forgotten.update(self._forget(manifest, prefix, generation, keep=paths))
+                touched.extend(sorted(paths))
+                for path in sorted(paths):
+                    old = manifest['files'].get(path)
+                    manifest['files'][path] = self._entry(plant_name, path, generation)
+                    manifest['deleted'].pop(path, None)
+                    if old is None:
+                        added.append(path)
+                    elif old['sha256'] != manifest['files'][path]['sha256']:
+                        forgotten[path] = old
+                        modified.append(path)
+            manifest['generation'] = generation
+            self._save(plant_name, manifest)
+            removed_paths = sorted(p for p in forgotten if p not in manifest['files'])
+            event = {
+                'generation': generation,
+                'added': [file_listing_entry(p, manifest['files'][p]) for p in added],
+                'modified': [file_listing_entry(p, manifest['files'][p]) for p in modified],
+                'removed': removed_paths,
+            }
+            # Counted under the lock so concurrent writers record the totals in order
+            if touched or removed_paths:
+                touch_plant(plant_name, len(manifest['files']), sum(e['size'] for e in manifest['files'].values()))
+        self._release([e['sha256'] for e in forgotten.values()])
+        # Every re-read path is re-indexed, a manifest built on first use already lists new files
+        search_index.update(plant_name, changed=touched, removed=removed_paths)
+        if added or modified or removed_paths:
+            plant_events.publish(plant_name, event)
+        return generation
+
+    def digests(self, plant_name, prefix):
+        """Hashes of the files at or under a path"""
+        manifest = self.get(plant_name)
+        return [e['sha256'] for p, e in manifest['files'].items() if p == prefix or p.startswith(prefix + '/')]
+
+    def _release(self, digests):
+        """Let the blob store free content that this plant no longer links to"""
+        if DEDUPLICATE_UPLOADS:
+            for digest in digests:
+                blob_store.release(digest)
+
+    def _forget(self, manifest, prefix, generation, keep=()):
+        """Drop paths at or under prefix, returns the dropped entries"""
+        forgotten = {}
+        for path in [p for p in manifest['files'] if p == prefix or p.startswith(prefix + '/')]:
+            if path not in keep:
+                forgotten[path] = manifest['files'].pop(path)
+                manifest['deleted'][path] = generation
+
+        # Old tombstones are dropped; clients older than that get a full listing
+        if len(manifest['deleted']) > MANIFEST_MAX_TOMBSTONES:
+            ordered = sorted(manifest['deleted'].items(), key=lambda item: item[1])
+            dropped = ordered[:len(ordered) - MANIFEST_MAX_TOMBSTONES]
+            manifest['oldest_generation'] = dropped[-1][1]
+            manifest['deleted'] = dict(ordered[len(dropped):])
+        return forgotten
+
+def file_listing_entry(path, entry):
+    """How a manifest entry is shown to clients"""
+    return {
+        'path': path,
+        'name': path.rsplit('/', 1)[-1],
+        'type': 'file',
+        'size': entry['size'],
+        'mtime': entry['mtime'],
+        'hash': entry['sha256'],
+    }
+
+class EventHub:
+    """Fan-out of plant change events to server-sent event subscribers, with caps on open streams"""
+
+    def __init__(self, max_queue=100, max_streams=None, max_per_user=None, max_per_plant=None):
+        self.max_queue = max_queue
+        self.max_streams = max_streams
+        self.max_per_user = max_per_user
+        self.max_per_plant = max_per_plant
+        self._subscribers = {}
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, plant_name, username=None):
+        """A queue of the plant's events, or None when a cap on open streams is reached"""
+        events = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            subscribers = self._subscribers.get(plant_name, set())
+            user_streams = sum(1 for user in self._users.values() if user == username)
+            if ((self.max_streams is not None and len(self._users) >= self.max_streams)
+                    or (self.max_per_plant is not None and len(subscribers) >= self.max_per_plant)
+                    or (self.max_per_user is not None and user_streams >= self.max_per_user)):
+                return None
+            self._subscribers.setdefault(plant_name, set()).add(events)
+            self._users[events] = username
+        return events
+
+    def unsubscribe(self, plant_name, events):
+        with self._lock:
+            subscribers = self._subscribers.get(plant_name, set())
+            subscribers.discard(events)
+            self._users.pop(events, None)
+            if not subscribers:
+                self._subscribers.pop(plant_name, None)
+
+    def publish(self, plant_name, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(plant_name, ()))
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # A slow client gets told to reload the full listing instead
+                self.unsubscribe(plant_name, events)
+                events.queue.clear()
+                events.put_nowait({'reset': True})
+
+plant_events = EventHub(max_streams=EVENTS_MAX_STREAMS, max_per_user=EVENTS_MAX_PER_USER,
+                        max_per_plant=EVENTS_MAX_PER_PLANT)
+
+manifest_store = ManifestStore()
+
+SEARCH_SKIPPED_TAGS = re.compile(r'<(script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+SEARCH_TITLE = re.compile(r'<(title|h1)\b[^>]*>(.*?)</\1\s*>', re.IGNORECASE | re.DOTALL)
+SEARCH_TAG = re.compile(r'<[^>]*>')
+SEARCH_TERM = re.compile(r'\w{2,40}')
+
+def search_terms(text):
+    """Lowercased word tokens of a text"""
+    return SEARCH_TERM.findall(text.lower())
+
+def search_document(path, full_path):
+    """Read a plant file into (title, term counts, length), or None if it is not searchable"""
+    if os.path.splitext(path)[1].lower() not in SEARCH_EXTENSIONS:
+        return None
+    try:
+        if os.path.getsize(full_path) > SEARCH_MAX_FILE_SIZE:
+            return None
+        with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
+            text = f.read()
+    except OSError:
+        return None
+    title = path.rsplit('/', 1)[-1]
+    if path.lower().endswith(('.html', '.htm')):
+        text = SEARCH_SKIPPED_TAGS.sub(' ', text)
+        match = SEARCH_TITLE.search(text)
+        if match:
+            title = html.unescape(SEARCH_TAG.sub('', match.group(2))).strip()[:200] or title
+        text = html.unescape(SEARCH_TAG.sub(' ', text))
+    terms = search_terms(text)
+    return title, Counter(terms), len(terms)
+
+def search_plant_documents(plant_name):
+    """Searchable documents of a whole plant, run in rebuild worker processes"""
+    documents = {}
+    for path in manifest_store.get(plant_name)['files']:
+        document = search_document(path, os.path.join(plant_dir(plant_name), path))
+        if document:
+            documents[path] = document
+    return plant_name, documents
+
+class SearchIndex:
+    """SQLite inverted index of plant files, ranked with BM25
+
+    Kept up to date from ManifestStore.apply, so uploads, extractions, syncs
+    and deletes all reach it. Document count and total length are kept in a
+    small meta table so ranking never has to scan the documents.
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, plant TEXT NOT NULL, '
+                         'path TEXT NOT NULL, title TEXT NOT NULL, length INTEGER NOT NULL, UNIQUE (plant, path))')
+            conn.execute('CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, doc INTEGER NOT NULL, '
+                         'tf INTEGER NOT NULL, PRIMARY KEY (term, doc)) WITHOUT ROWID')
+            conn.execute('CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('docs', 0), ('length', 0)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _remove(self, conn, condition, args):
+        rows = conn.execute(f'SELECT id, length FROM docs WHERE {condition}', args).fetchall()
+        for doc_id, _ in rows:
+            conn.execute('DELETE FROM postings WHERE doc = ?', (doc_id,))
+        conn.execute(f'DELETE FROM docs WHERE {condition}', args)
+        conn.execute("UPDATE meta SET value = value - ? WHERE key = 'docs'", (len(rows),))
+        conn.execute("UPDATE meta SET value = value - ? WHERE key = 'length'", (sum(r[1] for r in rows),))
+
+    def _add(self, conn, plant_name, path, document):
+        title, counts, length = document
+        doc_id = conn.execute('INSERT INTO docs (plant, path, title, length) VALUES (?, ?, ?, ?)',
+                              (plant_name, path, title, length)).lastrowid
+        conn.executemany('INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)',
+                         [(term, doc_id, tf) for term, tf in counts.items()])
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'docs'")
+        conn.execute("UPDATE meta SET value = value + ? WHERE key = 'length'", (length,))
+
+    def update(self, plant_name, changed=(), removed=()):
+        """Re-index changed files and drop removed ones"""
+        with metrics.timer('search_index'):
+            documents = {path: search_document(path, os.path.join(plant_dir(plant_name), path)) for path in changed}
+            with self._connect() as conn:
+                for path in list(removed) + list(documents):
+                    self._remove(conn, 'plant = ? AND path = ?', (plant_name, path))
+                for path, document in documents.items():
+                    if document:
+                        self._add(conn, plant_name, path, document)
+
+    def replace_plant(self, plant_name, documents):
+        """Swap all documents of a plant at once"""
+        with self._connect() as conn:
+            self._remove(conn, 'plant = ?', (plant_name,))
+            for path, document in documents.items():
+                self._add(conn, plant_name, path, document)
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM postings')
+            conn.execute('DELETE FROM docs')
+            conn.execute('UPDATE meta SET value = 0')
+
+    def search(self, query, offset=0, limit=20):
+        """Rank documents matching any query term, returns (total, results)"""
+        terms = list(dict.fromkeys(search_terms(query)))[:SEARCH_MAX_TERMS]
+        if not terms:
+            return 0, []
+        conn = self._connect()
+        with metrics.timer('search_query'):
+            meta = dict(conn.execute('SELECT key, value FROM meta').fetchall())
+            doc_count = max(meta['docs'], 1)
+            average_length = max(meta['length'] / doc_count, 1)
+            scores = {}
+            for term in terms:
+                postings = conn.execute('SELECT p.doc, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.doc '
+                                        'WHERE p.term = ?', (term,)).fetchall()
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf, length in postings:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[doc_id] = scores.get(doc_id, 0) + idf * tf * (self.k1 + 1) / norm
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            page = ranked[offset:offset + limit]
+            results = []
+            for doc_id, score in page:
+                plant_name, path, title = conn.execute('SELECT plant, path, title FROM docs WHERE id = ?',
+                                                       (doc_id,)).fetchone()
+                results.append({'plant': plant_name, 'path': path, 'title': title, 'score': round(score, 4)})
+        return len(ranked), results
+
+    def rebuild(self, processes=None, log=print):
+        """Index every plant from scratch, reading and tokenizing plants in parallel processes"""
+        self.clear()
+        done = 0
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for plant_name, documents in pool.map(search_plant_documents, iter_plant_names(), chunksize=16):
+                self.replace_plant(plant_name, documents)
+                done += 1
+                if done % 1000 == 0:
+                    log(f'Indexed {done} plants')
+        log(f'Indexed {done} plants 🌱')
+
+search_index = SearchIndex(SEARCH_DB)
+
+class BlobStore:
+    """Content-addressed store, each blob is kept once and hardlinked into plants
+
+    A blob's reference count is its hardlink count minus the store's own link,
+    so a blob is freed once no plant file links to it anymore.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _tmp_path(self):
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        return os.path.join(tmp_dir, uuid.uuid4().hex)
+
+    def _put(self, path, blob):
+        with contextlib.suppress(FileExistsError):
+            os.link(path, blob)
+
+    def _add(self, path, digest, target=None):
+        """Link a file into the store unless the blob already exists, then put the blob at target
+
+        Both happen under one lock, so a release cannot free the blob in between. A
+        blob another worker freed anyway is put back from path, which holds the same content.
+        """
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp_path = hidden_tmp_path(target) if target else None
+        with self._lock:
+            if not os.path.exists(blob):
+                self._put(path, blob)
+                if target == path:
+                    return blob
+            if target is None:
+                return blob
+            try:
+                os.link(blob, tmp_path)
+            except FileNotFoundError:
+                self._put(path, blob)
+                if target == path:
+                    return blob
+                os.link(blob, tmp_path)
+        os.replace(tmp_path, target)
+        return blob
+
+    def ingest(self, stream, target=None):
+        """Store a stream, hashing it as it is written, and return its digest
+
+        With a target the blob is linked there too, before the temp copy is gone.
+        """
+        tmp_path = self._tmp_path()
+        digest = hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            for block in iter(lambda: stream.read(1024 * 1024), b''):
+                digest.update(block)
+                f.write(block)
+        digest = digest.hexdigest()
+        try:
+            self._add(tmp_path, digest, target)
+        finally:
+            os.remove(tmp_path)
+        return digest
+
+    def adopt(self, path):
+        """Replace a file with a link to the matching blob, storing it if it is new"""
+        digest = file_digest(path)
+        try:
+            self._add(path, digest, target=path)
+        except OSError:
+            # Different filesystem or no hardlink support, keep the plain copy
+            pass
+        return digest
+
+    def adopt_tree(self, root):
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if not is_compressed_variant(dirpath, name):
+                    self.adopt(os.path.join(dirpath, name))
+
+    def release(self, digest):
+        """Free a blob when the store holds the only link left"""
+        blob = self.blob_path(digest)
+        with self._lock:
+            try:
+                if os.stat(blob).st_nlink <= 1:
+                    os.remove(blob)
+            except FileNotFoundError:
+                pass
+
+blob_store = BlobStore(BLOBS_DIR)
+
+class JobQueue:
+    """Small durable job queue, each job is a JSON file in JOBS_DIR run on a thread pool
+
+    Jobs left queued or running by a previous process are picked up again
+    by recover(). A lock file per job keeps two workers from running it.
+    """
+
+    def __init__(self, jobs_dir, workers, max_pending):
+        self.jobs_dir = jobs_dir
+        self.handlers = {}
+        self.max_pending = max_pending
+        self.token = f'{os.getpid()}:{uuid.uuid4().hex}'
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._started_pid = None
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def start(self):
+        """Pick up jobs left by earlier processes, once in each serving process
+
+        Never called at import, so neither a preloading gunicorn master nor
+        processes forked for other work (like search-rebuild) run jobs.
+        """
+        with self._pending_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        self.recover()
+
+    def busy(self):
+        """True when max_pending jobs are already waiting or running, new optional work should be refused"""
+        return self._pending >= self.max_pending
+
+    def _queue(self, job_id):
+        with self._pending_lock:
+            self._pending += 1
+        self._pool.submit(self._run, job_id).add_done_callback(self._finished)
+
+    def _finished(self, future):
+        with self._pending_lock:
+            self._pending -= 1
+
+    def handler(self, kind):
+        """Register the function that runs jobs of a kind"""
+        def decorator(func):
+            self.handlers[kind] = func
+            return func
+        return decorator
+
+    def _path(self, job_id, suffix='.json'):
+        return os.path.join(self.jobs_dir, job_id + suffix)
+
+    def _save(self, job):
+        job['updated'] = datetime.datetime.now().isoformat()
+        path = self._path(job['id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(job, f)
+        os.replace(path + '.tmp', path)
+
+    def get(self, job_id):
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self._path(job_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def submit(self, kind, owner=None, **args):
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'owner': owner,
+            'args': args,
+            'status': 'queued',
+            'created': datetime.datetime.now().isoformat(),
+        }
+        self._save(job)
+        self._queue(job['id'])
+        return job
+
+    def _claim(self, job_id):
+        lock_path = self._path(job_id, '.lock')
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(lock_path, 'r') as f:
+                    pid, token = f.read().split(':', 1)
+            except (OSError, ValueError):
+                return False
+            if f'{pid}:{token}' == self.token or (int(pid) != os.getpid() and pid_alive(int(pid))):
+                return False
+            # The process holding the lock is gone
+            os.remove(lock_path)
+            return self._claim(job_id)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.token)
+        return True
+
+    def _run(self, job_id):
+        if not self._claim(job_id):
+            return
+        try:
+            job = self.get(job_id)
+            if job is None or job['status'] in ('done', 'failed'):
+                return
+            job['status'] = 'running'
+            self._save(job)
+            try:
+                job['result'] = self.handlers[job['kind']](**job['args'])
+                job['status'] = 'done'
+            except Exception as e:
+                job['status'] = 'failed'
+                job['error'] = str(e)
+            self._save(job)
+        finally:
+            os.remove(self._path(job_id, '.lock'))
+
+    def recover(self):
+        """Requeue unfinished jobs and forget finished ones past JOB_RETENTION"""
+        cutoff = time.time() - JOB_RETENTION
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith('.json'):
+                continue
+            job = self.get(name[:-5])
+            if job is None:
+                continue
+            if job['status'] in ('queued', 'running'):
+                self._queue(job['id'])
+            elif os.path.getmtime(self._path(job['id'])) < cutoff:
+                os.remove(self._path(job['id']))
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+job_queue = JobQueue(JOBS_DIR, JOB_WORKERS, JOB_QUEUE_LIMIT)
+
+@app.before_request
+def start_job_queue():
+    # Servers without a post_fork hook, like `flask run`, start jobs with their first request
+    job_queue.start()
 
 def create_plant_info(plant_name, username):
     """Create user.json for a plant"""
-    plant_path = os.path.join(PLANTS_DIR, plant_name)
+    plant_path = plant_dir(plant_name)
     os.makedirs(plant_path, exist_ok=True)
 
     user_info = {
@@ -49,20 +1838,353 @@ def create_plant_info(plant_name, username):
 
     with open(os.path.join(plant_path, "user.json"), 'w') as f:
         json.dump(user_info, f, indent=2)
+    plant_index.put(plant_name, user_info)
+    plant_catalog.add(plant_name, username, user_info['created'])
+
+def quota_room(plant_name, freed_size=0, freed_files=0, exclude=None, usage=None):
+    """Bytes and files a plant can still take within its own and its owner's quota
+
+    Space reserved by uploads in flight counts as taken, except the reservation named by exclude.
+    """
+    if usage is None:
+        usage = plant_catalog.usage(plant_name, exclude=exclude)
+    if usage is None:
+        return math.inf, math.inf
+    _, plant_files, plant_bytes, owner_files, owner_bytes = usage
+
+    def room(limit, used):
+        return math.inf if limit is None else limit - used
+
+    size = min(room(QUOTA_PLANT_BYTES, plant_bytes), room(QUOTA_USER_BYTES, owner_bytes)) + freed_size
+    files = min(room(QUOTA_PLANT_FILES, plant_files), room(QUOTA_USER_FILES, owner_files)) + freed_files
+    return size, files
+
+def quota_error(plant_name, size, files=1, freed_size=0, freed_files=0, exclude=None, usage=None):
+    """Why adding size bytes in files files would go over quota, or None if it fits"""
+    room_size, room_files = quota_room(plant_name, freed_size, freed_files, exclude, usage)
+    if size > room_size:
+        return f'Not enough space left in your quota, {max(room_size, 0)} bytes free 💔'
+    if files > room_files:
+        return f'Too many files for your quota, room for {max(room_files, 0)} more 💔'
+    return None
+
+def quota_reserve(key, plant_name, staging, reserve, **check):
+    """Check the quota and hold reserve=(bytes, files) for an upload in flight in one step
+
+    check takes quota_error's size, files, freed_size and freed_files. Returns an error or None.
+    """
+    return plant_catalog.reserve(key, plant_name, staging, reserve[0], reserve[1],
+                                 lambda usage: quota_error(plant_name, usage=usage, **check))
+
+def quota_response(message):
+    return jsonify({'error': message}), 413
+
+def plant_disk_usage(plant_name):
+    """Count files and bytes on disk like the manifest does, for reconciling"""
+    plant_path = plant_dir(plant_name)
+    files = size = 0
+    for root, dirs, names in os.walk(plant_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in names:
+            if name.startswith('.') or (root == plant_path and name == 'user.json') or is_compressed_variant(root, name):
+                continue
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+                files += 1
+            except OSError:
+                pass
+    return files, size
+
+def remove_staging(plant_name, staging):
+    """Delete the staging file or folder of an upload or sync, with its state"""
+    path = os.path.join(plant_dir(plant_name), staging)
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    for stale in (path, path + '.json'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(stale)
+
+@job_queue.handler('reconcile_usage')
+def reconcile_usage_job():
+    """Fix counter drift left by crashes or changes made outside the app"""
+    fixed = 0
+    stale_before = time.time() - UPLOAD_STALE_AFTER
+    for plant_name in iter_plant_names():
+        # Uploads and syncs nobody touched for UPLOAD_STALE_AFTER were abandoned
+        with os.scandir(plant_dir(plant_name)) as it:
+            for entry in it:
+                if not entry.name.startswith(('.upload-', '.sync-')) or entry.name.endswith('.json'):
+                    continue
+                if entry.stat(follow_symlinks=False).st_mtime < stale_before:
+                    remove_staging(plant_name, entry.name)
+
+        usage = plant_catalog.usage(plant_name, reserved=False)
+        if usage is None:
+            continue
+        files, size = plant_disk_usage(plant_name)
+        if (files, size) != (usage[1], usage[2]):
+            plant_catalog.update(plant_name, files, size)
+            fixed += 1
+
+    # Reservations whose upload is gone would hold space for good
+    for key, plant_name, staging in plant_catalog.reservations():
+        if not os.path.exists(os.path.join(plant_dir(plant_name), staging)):
+            plant_catalog.release(key)
+    plant_catalog.recount_owners()
+    return {'message': f'Reconciled usage, {fixed} plants fixed 🌱', 'fixed': fixed}
+
+def touch_plant(plant_name, files, size):
+    """Record a change to a plant's files in user.json and the catalog"""
+    now = datetime.datetime.now().isoformat()
+    info = plant_index.get(plant_name)
+    if info is not None:
+        info = dict(info, last_modified=now)
+        path = os.path.join(plant_dir(plant_name), "user.json")
+        # Other worker processes may be writing it too, so each writer gets its own hidden temp file
+        tmp_path = os.path.join(plant_dir(plant_name), f'.user.json-{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(info, f, indent=2)
+        os.replace(tmp_path, path)
+        plant_index.put(plant_name, info)
+    plant_catalog.update(plant_name, files, size, now)
+
+def placeholder_page(plant_name):
+    """Content shown for plants without an index.html"""
+    return f"<h1>🌱 Welcome to {escape(plant_name)}!</h1><p>This plant is growing with love! Add an index.html file to see your content here! 💚</p>"
+
+def cache_max_age(filename):
+    """Browser cache lifetime for a plant file"""
+    return CACHE_MAX_AGE.get(os.path.splitext(filename)[1].lower(), DEFAULT_CACHE_MAX_AGE)
+
+def is_compressible(filename):
+    return os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+def remove_compressed_variants(file_path):
+    """Remove the .gz/.br siblings of a file"""
+    for suffix in COMPRESSED_SUFFIXES.values():
+        try:
+            os.remove(file_path + suffix)
+        except FileNotFoundError:
+            pass
+
+def write_compressed_variants(file_path):
+    """Write precompressed siblings of a text file so it never has to be compressed per request"""
+    remove_compressed_variants(file_path)
+    if not is_compressible(file_path):
+        return
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    variants = {'.gz': gzip.compress(data, compresslevel=9)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data)
+    for suffix, compressed in variants.items():
+        # Only keep variants that are actually smaller
+        if len(compressed) >= len(data):
+            continue
+        tmp_path = hidden_tmp_path(file_path + suffix)
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, file_path + suffix)
+
+def compress_tree(root):
+    """Write compressed variants for every compressible file under root"""
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if is_compressible(name):
+                write_compressed_variants(os.path.join(dirpath, name))
+
+def is_compressed_variant(plant_path, name):
+    """Whether a directory entry is a generated .gz/.br sibling"""
+    base, suffix = os.path.splitext(name)
+    return (suffix in COMPRESSED_SUFFIXES.values() and is_compressible(base)
+            and os.path.exists(os.path.join(plant_path, base)))
+
+def negotiate_encoding(plant_path, filename):
+    """Pick a precompressed sibling the client accepts, (encoding, name) or (None, filename)"""
+    if not is_compressible(filename):
+        return None, filename
+    file_path = safe_join(plant_path, filename)
+    if file_path is None:
+        return None, filename
+    for encoding, suffix in COMPRESSED_SUFFIXES.items():
+        if encoding not in request.accept_encodings:
+            continue
+        try:
+            # A stale sibling (older than the file) is never served
+            if os.stat(file_path + suffix).st_mtime_ns >= os.stat(file_path).st_mtime_ns:
+                return encoding, filename + suffix
+        except OSError:
+            continue
+    return None, filename
+
+class ExtractionError(Exception):
+    """A zip upload broke one of the extraction limits"""
+
+# Progress of running zip extractions, (plant_name, folder_name) -> {'written': ..., 'total': ...}
+extraction_progress = {}
+
+def extract_zip(source, dest, on_progress=None, room=(math.inf, math.inf)):
+    """Extract a zip member by member, enforcing size, file count, compression ratio and quota limits
+
+    room is the (bytes, files) the quota still allows.
+    """
+    with metrics.timer('zip_extraction'):
+        count, written = _extract_zip(source, dest, on_progress, room)
+    metrics.inc('plant_extracted_bytes_total', written)
+    return count, written
+
+def _extract_zip(source, dest, on_progress, room):
+    room_size, room_files = room
+    with zipfile.ZipFile(source) as zip_ref:
+        members = [m for m in zip_ref.infolist() if not m.is_dir()]
+        if len(members) > ZIP_MAX_FILES:
+            raise ExtractionError(f'Too many files in zip (limit {ZIP_MAX_FILES})')
+        if len(members) > room_files:
+            raise ExtractionError(f'Too many files for your quota, room for {max(room_files, 0)} more')
+        total = sum(m.file_size for m in members)
+        if total > ZIP_MAX_TOTAL_SIZE:
+            raise ExtractionError(f'Zip expands to more than {ZIP_MAX_TOTAL_SIZE} bytes')
+        if total > room_size:
+            raise ExtractionError(f'Not enough space left in your quota, {max(room_size, 0)} bytes free')
+
+        written = 0
+        for member in members:
+            if member.file_size > ZIP_CHUNK_SIZE and member.file_size > member.compress_size * ZIP_MAX_RATIO:
+                raise ExtractionError(f'{member.filename} is compressed suspiciously well')
+            target = safe_join(dest, member.filename.replace('\\', '/').lstrip('/'))
+            if target is None:
+                raise ExtractionError(f'{member.filename} points outside the folder')
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            # Sizes in the zip headers can lie, so count the bytes we really write
+            with zip_ref.open(member) as src, open(target, 'wb') as dst:
+                while True:
+                    chunk = src.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if written > ZIP_MAX_TOTAL_SIZE:
+                        raise ExtractionError(f'Zip expands to more than {ZIP_MAX_TOTAL_SIZE} bytes')
+                    if written > room_size:
+                        raise ExtractionError(f'Not enough space left in your quota, {max(room_size, 0)} bytes free')
+                    dst.write(chunk)
+                    if on_progress:
+                        on_progress(written, total)
+        return len(members), written
+
+def install_folder(plant_name, folder_name, source, reservation=None):
+    """Extract a zip into a staging folder, then swap it into place so a failed upload leaves nothing behind
+
+    reservation names the quota reservation of the uploaded archive, its space is free to use.
+    """
+    plant_path = plant_dir(plant_name)
+    extract_path = os.path.join(plant_path, folder_name)
+    staging_path = os.path.join(plant_path, f'.extract-{uuid.uuid4().hex}')
+    progress = extraction_progress[(plant_name, folder_name)] = {'written': 0, 'total': 0}
+
+    def on_progress(written, total):
+        progress['written'] = written
+        progress['total'] = total
+
+    # A folder being replaced gives its space back
+    replaced = [e['size'] for p, e in manifest_store.get(plant_name)['files'].items()
+                if p == folder_name or p.startswith(folder_name + '/')]
+    room = quota_room(plant_name, sum(replaced), len(replaced), exclude=reservation)
+
+    # The staging folder must still be in the plant when it is renamed, so a sync cannot swap the tree meanwhile
+    try:
+        with manifest_store.writing(plant_name):
+            extract_zip(source, staging_path, on_progress, room)
+            if DEDUPLICATE_UPLOADS:
+                blob_store.adopt_tree(staging_path)
+            compress_tree(staging_path)
+            if os.path.exists(extract_path):
+                trash(plant_name, folder_name)
+            os.rename(staging_path, extract_path)
+            manifest_store.update(plant_name, folder_name)
+    except BaseException:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+    finally:
+        extraction_progress.pop((plant_name, folder_name), None)
+
+def is_internal_path(filename):
+    """Staging files and folders that must never be served"""
+    return any(part.startswith(('.extract-', '.upload-', '.trash-', '.sync-', '.manifest.json')) for part in filename.split('/'))
+
+def trash(plant_name, path, owner=None):
+    """Move a file or folder out of the way at once and delete it in the background"""
+    plant_path = plant_dir(plant_name)
+    trash_name = f'.trash-{uuid.uuid4().hex}'
+    digests = manifest_store.digests(plant_name, path)
+    os.rename(os.path.join(plant_path, path), os.path.join(plant_path, trash_name))
+    return job_queue.submit('purge', owner=owner, plant_name=plant_name, trash_name=trash_name, digests=digests)
+
+@job_queue.handler('purge')
+def purge_job(plant_name, trash_name, digests):
+    path = os.path.join(plant_dir(plant_name), trash_name)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    if DEDUPLICATE_UPLOADS:
+        for digest in digests:
+            blob_store.release(digest)
+
+@job_queue.handler('extract')
+def extract_job(plant_name, folder_name, archive, reservation=None):
+    try:
+        install_folder(plant_name, folder_name, os.path.join(plant_dir(plant_name), archive), reservation)
+    finally:
+        os.remove(os.path.join(plant_dir(plant_name), archive))
+        if reservation:
+            plant_catalog.release(reservation)
+    return {'message': f'Folder {folder_name} uploaded with love! 🌱'}
+
+def exchange_paths(a, b):
+    """Swap two directories atomically with renameat2(RENAME_EXCHANGE), raises OSError where that isn't supported
+
+    There is no fallback: swapping with three renames leaves a moment without
+    a directory at a, when a request could create a new plant in its place.
+    """
+    renameat2 = getattr(libc, 'renameat2', None) if libc else None
+    if renameat2 is None:
+        raise OSError(errno.ENOSYS, 'renameat2 is not available', a)
+    at_fdcwd, rename_exchange = -100, 2
+    if renameat2(at_fdcwd, os.fsencode(a), at_fdcwd, os.fsencode(b), rename_exchange) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), a)
+
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    libc = None
+
+def stream_size(stream):
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+def queue_extraction(plant_name, folder_name, archive, owner=None, reservation=None):
+    """Extract an archive already inside the plant as a background job"""
+    job = job_queue.submit('extract', owner=owner, plant_name=plant_name, folder_name=folder_name, archive=archive,
+                           reservation=reservation)
+    return {'success': True, 'job_id': job['id'], 'message': f'Folder {folder_name} is being planted... 🌱'}
 
 def get_plant_owner(plant_name):
     """Get the owner of a plant"""
-    user_json_path = os.path.join(PLANTS_DIR, plant_name, "user.json")
-    if os.path.exists(user_json_path):
-        with open(user_json_path, 'r') as f:
-            return json.load(f).get('owner')
-    return None
+    with metrics.timer('owner_lookup'):
+        info = plant_index.get(plant_name)
+    return info.get('owner') if info else None
 
 @app.route('/')
 def home():
     if 'username' not in session:
-        return render_template_string(AUTH_TEMPLATE)
-    return render_template_string(WELCOME_TEMPLATE, username=session['username'])
+        return static_page('auth')
+    return render_page('welcome', username=session['username'])
 
 @app.route('/register', methods=['POST'])
 def register():
@@ -80,15 +2202,17 @@ def register():
     if len(password) < 4:
         return jsonify({'error': 'Password should be at least 4 characters! 🌸'}), 400
 
-    users = load_users()
-    if username in users:
-        return jsonify({'error': 'Username already exists! Please choose another one! 🌺'}), 400
+    try:
+        password_hash = password_pool.run(hash_password, password)
+    except PoolBusy:
+        return busy_response()
 
-    users[username] = {
-        'password': hash_password(password),
+    record = {
+        'password': password_hash,
         'created': datetime.datetime.now().isoformat()
     }
-    save_users(users)
+    if not add_user(username, record):
+        return jsonify({'error': 'Username already exists! Please choose another one! 🌺'}), 400
 
     session['username'] = username
     return jsonify({'success': True, 'message': f'Welcome to Plant, {username}! 🌱💚'})
@@ -99,12 +2223,20 @@ def login():
     username = data.get('username', '').strip()
     password = data.get('password', '')
 
-    users = load_users()
-    if username not in users:
+    user = get_user(username)
+    if user is None:
         return jsonify({'error': 'User not found! 🥀'}), 400
 
-    if users[username]['password'] != hash_password(password):
-        return jsonify({'error': 'Wrong password! 💔'}), 400
+    try:
+        if not password_pool.run(verify_password, password, user['password']):
+            return jsonify({'error': 'Wrong password! 💔'}), 400
+
+        # Old hashes are upgraded while we still have the plain password
+        if needs_rehash(user['password']):
+            user['password'] = password_pool.run(hash_password, password)
+            user_store.put(username, user)
+    except PoolBusy:
+        return busy_response()
 
     session['username'] = username
     return jsonify({'success': True, 'message': f'Welcome back, {username}! 🌸💚'})
@@ -114,7 +2246,10 @@ def view_plant(plant_name):
     if 'username' not in session:
         return redirect(url_for('home'))
 
-    plant_path = os.path.join(PLANTS_DIR, plant_name)
+    if not is_valid_plant_name(plant_name):
+        abort(404)
+
+    plant_path = plant_dir(plant_name)
 
     # Create plant if it doesn't exist
     if not os.path.exists(plant_path):
@@ -123,23 +2258,55 @@ def view_plant(plant_name):
     # Check if user is owner
     is_owner = get_plant_owner(plant_name) == session['username']
 
-    # Look for index.html
+    # Look for index.html, the cache key changes whenever it does
     index_path = os.path.join(plant_path, "index.html")
-    if os.path.exists(index_path):
-        with open(index_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+    if VIEWER_MODE == 'url':
+        # The shell doesn't depend on index.html at all in this mode
+        stat = None
+        cache_key = (plant_name, 'url', is_owner)
     else:
-        content = f"<h1>🌱 Welcome to {plant_name}!</h1><p>This plant is growing with love! Add an index.html file to see your content here! 💚</p>"
-
-    return render_template_string(PLANT_VIEWER_TEMPLATE,
-                                plant_name=plant_name,
-                                content=content,
-                                is_owner=is_owner,
-                                username=session['username'])
+        try:
+            stat = os.stat(index_path)
+            cache_key = (plant_name, stat.st_mtime_ns, stat.st_size, is_owner)
+        except OSError:
+            stat = None
+            cache_key = (plant_name, None, None, is_owner)
+
+    cached = viewer_cache.get(cache_key)
+    metrics.inc('plant_viewer_cache_misses_total' if cached is None else 'plant_viewer_cache_hits_total')
+    if cached is None:
+        content_url = None
+        if VIEWER_MODE == 'url':
+            content = None
+            content_url = url_for('serve_plant_file', plant_name=plant_name, filename='index.html')
+        elif stat is not None:
+            with metrics.timer('file_io'), open(index_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        else:
+            content = placeholder_page(plant_name)
+
+        body = render_page('plant_viewer',
+                           plant_name=plant_name,
+                           content=content,
+                           content_url=content_url,
+                           is_owner=is_owner,
+                           username=session['username']).encode('utf-8')
+        cached = (body, hashlib.sha1(body).hexdigest())
+        viewer_cache.put(cache_key, cached)
+
+    body, etag = cached
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/<plant_name>/<path:filename>')
 def serve_plant_file(plant_name, filename):
-    plant_path = os.path.join(PLANTS_DIR, plant_name)
+    if not is_valid_plant_name(plant_name):
+        abort(404)
+
+    plant_path = plant_dir(plant_name)
     if not os.path.exists(plant_path):
         abort(404)
 
@@ -147,11 +2314,93 @@ def serve_plant_file(plant_name, filename):
     if filename == 'user.json':
         abort(403)
 
-    try:
-        return send_from_directory(plant_path, filename)
-    except:
+    if is_internal_path(filename):
         abort(404)
 
+    # Plants without an index.html still get a page in the viewer
+    if filename == 'index.html' and not os.path.exists(os.path.join(plant_path, filename)):
+        return placeholder_page(plant_name)
+
+    if SENDFILE_MODE == 'x-accel-redirect':
+        file_path = safe_join(plant_path, filename)
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        # The proxy maps the prefix to PLANTS_DIR, so the path follows the plant's layout (flat or sharded)
+        relative = os.path.relpath(file_path, PLANTS_DIR).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX + quote(relative)
+        if cache_max_age(filename):
+            response.cache_control.public = True
+            response.cache_control.max_age = cache_max_age(filename)
+    else:
+        # send_from_directory handles ETag, Last-Modified, If-None-Match and Range requests
+        encoding, served_name = negotiate_encoding(plant_path, filename)
+        try:
+            response = send_from_directory(os.path.abspath(plant_path), served_name,
+                                           mimetype=mimetypes.guess_type(filename)[0],
+                                           max_age=cache_max_age(filename))
+        except NotFound:
+            abort(404)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if is_compressible(filename):
+            response.vary.add('Accept-Encoding')
+
+    if cache_max_age(filename) == 0:
+        response.cache_control.no_cache = True
+    return response
+
+def save_upload(plant_name, file, owner=None, update_manifest=True):
+    """Save one uploaded file (or zip folder) into a plant, returns a result dict
+
+    A saved regular file's path is in the result, so a caller saving many files can
+    turn update_manifest off and apply them all to the manifest at once.
+    """
+    plant_path = plant_dir(plant_name)
+    filename = secure_filename(file.filename)
+    if not filename or filename == 'user.json':
+        return {'error': 'Invalid file name'}
+
+    # Handle zip files as folders
+    if filename.endswith('.zip'):
+        folder_name = filename[:-4]  # Remove .zip extension
+
+        # Big archives are extracted in the background, both ways raise PoolBusy when too many are underway
+        if stream_size(file.stream) > ASYNC_EXTRACT_SIZE:
+            if job_queue.busy():
+                raise PoolBusy()
+            archive = f'.upload-{uuid.uuid4().hex}.zip'
+            with manifest_store.writing(plant_name):
+                file.save(os.path.join(plant_path, archive))
+            return queue_extraction(plant_name, folder_name, archive, owner=owner)
+
+        try:
+            extraction_pool.run(install_folder, plant_name, folder_name, file.stream)
+        except (ExtractionError, zipfile.BadZipFile) as e:
+            return {'error': f'Could not extract {filename}: {e} 💔'}
+
+        return {'success': True, 'message': f'Folder {folder_name} uploaded with love! 🌱'}
+
+    # Save regular file, always through a rename since plant files may be shared hardlinks
+    file_path = os.path.join(plant_path, filename)
+    replaced = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+    error = quota_error(plant_name, stream_size(file.stream), freed_size=replaced, freed_files=int(replaced > 0))
+    if error:
+        return {'error': error}
+    with manifest_store.writing(plant_name):
+        with metrics.timer('file_io'):
+            if DEDUPLICATE_UPLOADS:
+                blob_store.ingest(file.stream, target=file_path)
+            else:
+                tmp_path = hidden_tmp_path(file_path)
+                file.save(tmp_path)
+                os.replace(tmp_path, file_path)
+            write_compressed_variants(file_path)
+        if update_manifest:
+            manifest_store.update(plant_name, filename)
+
+    return {'success': True, 'message': f'File {filename} uploaded with love! 🌱', 'path': filename}
+
 @app.route('/api/upload/<plant_name>', methods=['POST'])
 def upload_file(plant_name):
     if 'username' not in session:
@@ -161,6 +2410,11 @@ def upload_file(plant_name):
     if get_plant_owner(plant_name) != session['username']:
         return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
 
+    # Turn away uploads that cannot fit before reading the body
+    error = quota_error(plant_name, request.content_length or 0)
+    if error:
+        return quota_response(error)
+
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
 
@@ -168,32 +2422,275 @@ def upload_file(plant_name):
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
 
-    plant_path = os.path.join(PLANTS_DIR, plant_name)
-    filename = secure_filename(file.filename)
+    try:
+        result = save_upload(plant_name, file, owner=session['username'])
+    except PoolBusy:
+        return busy_response()
+    result.pop('path', None)
+    return jsonify(result), 200 if result.get('success') else 400
+
+@app.route('/api/upload/<plant_name>/batch', methods=['POST'])
+def upload_batch(plant_name):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
 
-    # Handle zip files as folders
-    if filename.endswith('.zip'):
-        folder_name = filename[:-4]  # Remove .zip extension
-        extract_path = os.path.join(plant_path, folder_name)
+    # Check if user is owner, once for the whole batch
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
 
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp_file:
-            file.save(tmp_file.name)
+    # Turn away batches that cannot fit before reading the body
+    error = quota_error(plant_name, request.content_length or 0)
+    if error:
+        return quota_response(error)
 
-            # Extract zip
-            os.makedirs(extract_path, exist_ok=True)
-            with zipfile.ZipFile(tmp_file.name, 'r') as zip_ref:
-                zip_ref.extractall(extract_path)
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return jsonify({'error': 'No file provided'}), 400
 
-        os.unlink(tmp_file.name)  # Clean up temp file
-        return jsonify({'success': True, 'message': f'Folder {folder_name} uploaded with love! 🌱'})
+    # Two uploads of the same name would race for the same path
+    seen = set()
+    futures = []
+    for file in files:
+        name = secure_filename(file.filename)
+        if name in seen:
+            futures.append((file.filename, None))
+            continue
+        seen.add(name)
+        futures.append((file.filename, upload_pool.submit(save_upload, plant_name, file, session['username'], False)))
 
-    # Save regular file
-    file_path = os.path.join(plant_path, filename)
-    file.save(file_path)
+    results = []
+    for original_name, future in futures:
+        try:
+            result = future.result() if future else {'error': 'Duplicate file in batch'}
+        except PoolBusy:
+            result = {'error': 'Plant is very busy right now, please try again in a moment! 🌱'}
+        results.append({'name': original_name, **result})
+
+    # All saved files become one new manifest generation
+    changed = [r.pop('path') for r in results if 'path' in r]
+    if changed:
+        manifest_store.apply(plant_name, changed=changed)
+
+    return jsonify({'success': all(r.get('success') for r in results), 'results': results})
 
+upload_state_lock = threading.Lock()
+
+def upload_state_path(plant_name, upload_id):
+    return os.path.join(plant_dir(plant_name), f'.upload-{upload_id}.json')
+
+def load_upload_state(plant_name, upload_id):
+    """Load the state of a chunked upload, None if it doesn't exist"""
+    if not all(c in '0123456789abcdef' for c in upload_id):
+        return None
+    try:
+        with open(upload_state_path(plant_name, upload_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_upload_state(plant_name, upload_id, state):
+    path = upload_state_path(plant_name, upload_id)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+def upload_status(upload_id, state):
+    return {
+        'upload_id': upload_id,
+        'filename': state['filename'],
+        'size': state['size'],
+        'chunk_size': state['chunk_size'],
+        'received': sorted(state['received']),
+    }
+
+@app.route('/api/upload/<plant_name>/chunked', methods=['POST'])
+def init_chunked_upload(plant_name):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    data = request.get_json()
+    filename = secure_filename(data.get('filename', ''))
+    size = data.get('size')
+    if not filename or filename == 'user.json':
+        return jsonify({'error': 'No file selected'}), 400
+    if not isinstance(size, int) or size < 0 or size > UPLOAD_MAX_SIZE:
+        return jsonify({'error': f'File size must be between 0 and {UPLOAD_MAX_SIZE} bytes'}), 400
+
+    # The declared size is held until commit, so parallel uploads cannot overbook the quota together
+    upload_id = uuid.uuid4().hex
+    error = quota_reserve(f'upload-{upload_id}', plant_name, f'.upload-{upload_id}', (size, 1), size=size)
+    if error:
+        return quota_response(error)
+    state = {
+        'filename': filename,
+        'size': size,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'sha256': data.get('sha256'),
+        'received': [],
+    }
+
+    # The staging file lives next to its final place so commit is a rename
+    with manifest_store.writing(plant_name):
+        with open(os.path.join(plant_dir(plant_name), f'.upload-{upload_id}'), 'wb') as f:
+            f.truncate(size)
+        save_upload_state(plant_name, upload_id, state)
+    return jsonify(upload_status(upload_id, state))
+
+@app.route('/api/upload/<plant_name>/chunked/<upload_id>', methods=['GET', 'PUT'])
+def chunked_upload(plant_name, upload_id):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    state = load_upload_state(plant_name, upload_id)
+    if state is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    if request.method == 'GET':
+        return jsonify(upload_status(upload_id, state))
+
+    offset = request.args.get('offset', type=int)
+    chunk_size = state['chunk_size']
+    if offset is None or offset < 0 or offset % chunk_size or offset >= max(state['size'], 1):
+        return jsonify({'error': f'Offset must be a multiple of {chunk_size} inside the file'}), 400
+    expected = min(chunk_size, state['size'] - offset)
+    if request.content_length != expected:
+        return jsonify({'error': f'Chunk at offset {offset} must be {expected} bytes'}), 400
+
+    # Write the request body straight into the staging file
+    with manifest_store.writing(plant_name):
+        with open(os.path.join(plant_dir(plant_name), f'.upload-{upload_id}'), 'r+b') as f:
+            f.seek(offset)
+            remaining = expected
+            while remaining:
+                data = request.stream.read(min(remaining, 1024 * 1024))
+                if not data:
+                    return jsonify({'error': 'Chunk ended early'}), 400
+                f.write(data)
+                remaining -= len(data)
+
+        with upload_state_lock:
+            state = load_upload_state(plant_name, upload_id)
+            if state is None:
+                return jsonify({'error': 'Upload not found'}), 404
+            index = offset // chunk_size
+            if index not in state['received']:
+                state['received'].append(index)
+                save_upload_state(plant_name, upload_id, state)
+
+    return jsonify(upload_status(upload_id, state))
+
+@app.route('/api/upload/<plant_name>/chunked/<upload_id>/commit', methods=['POST'])
+def commit_chunked_upload(plant_name, upload_id):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    state = load_upload_state(plant_name, upload_id)
+    if state is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    chunk_count = -(-state['size'] // state['chunk_size'])
+    missing = sorted(set(range(chunk_count)) - set(state['received']))
+    if missing:
+        return jsonify({'error': 'Upload is not complete', 'missing': missing}), 409
+
+    staging_path = os.path.join(plant_dir(plant_name), f'.upload-{upload_id}')
+    expected_hash = (request.get_json(silent=True) or {}).get('sha256') or state.get('sha256')
+    if expected_hash:
+        digest = hashlib.sha256()
+        with open(staging_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        if digest.hexdigest() != expected_hash.lower():
+            return jsonify({'error': 'Checksum mismatch, please upload again 💔'}), 422
+
+    filename = state['filename']
+    reservation = f'upload-{upload_id}'
+    if filename.endswith('.zip'):
+        folder_name = filename[:-4]
+        # When busy the upload is kept, so the commit can simply be retried
+        if state['size'] > ASYNC_EXTRACT_SIZE:
+            if job_queue.busy():
+                return busy_response()
+            os.remove(upload_state_path(plant_name, upload_id))
+            return jsonify(queue_extraction(plant_name, folder_name, f'.upload-{upload_id}', owner=session['username'],
+                                            reservation=reservation))
+        busy = False
+        try:
+            extraction_pool.run(install_folder, plant_name, folder_name, staging_path, reservation)
+        except PoolBusy:
+            busy = True
+            return busy_response()
+        except (ExtractionError, zipfile.BadZipFile) as e:
+            return jsonify({'error': f'Could not extract {filename}: {e} 💔'}), 400
+        finally:
+            if not busy:
+                os.remove(upload_state_path(plant_name, upload_id))
+                os.remove(staging_path)
+                plant_catalog.release(reservation)
+        return jsonify({'success': True, 'message': f'Folder {folder_name} uploaded with love! 🌱'})
+
+    # Check again now the bytes are here, the upload's own reservation is what it may use
+    with manifest_store.writing(plant_name):
+        file_path = os.path.join(plant_dir(plant_name), filename)
+        replaced = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+        error = quota_error(plant_name, os.path.getsize(staging_path), freed_size=replaced,
+                            freed_files=int(replaced > 0), exclude=reservation)
+        os.remove(upload_state_path(plant_name, upload_id))
+        if error:
+            os.remove(staging_path)
+            plant_catalog.release(reservation)
+            return quota_response(error)
+        os.replace(staging_path, file_path)
+        if DEDUPLICATE_UPLOADS:
+            blob_store.adopt(file_path)
+        write_compressed_variants(file_path)
+        manifest_store.update(plant_name, filename)
+    plant_catalog.release(reservation)
     return jsonify({'success': True, 'message': f'File {filename} uploaded with love! 🌱'})
 
+@app.route('/api/upload/<plant_name>/chunked/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(plant_name, upload_id):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    if load_upload_state(plant_name, upload_id) is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    # Throw the received chunks away and give the held quota back
+    with manifest_store.writing(plant_name):
+        remove_staging(plant_name, f'.upload-{upload_id}')
+    plant_catalog.release(f'upload-{upload_id}')
+    return jsonify({'success': True, 'message': 'Upload cancelled 🌱'})
+
+@app.route('/api/upload/<plant_name>/progress')
+def upload_progress(plant_name):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    extractions = [{'folder': folder, **progress}
+                   for (name, folder), progress in list(extraction_progress.items()) if name == plant_name]
+    return jsonify({'extractions': extractions})
+
 @app.route('/api/files/<plant_name>')
 def get_plant_files(plant_name):
     if 'username' not in session:
@@ -203,23 +2700,36 @@ def get_plant_files(plant_name):
     if get_plant_owner(plant_name) != session['username']:
         return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
 
-    plant_path = os.path.join(PLANTS_DIR, plant_name)
+    plant_path = plant_dir(plant_name)
     if not os.path.exists(plant_path):
-        return jsonify({'files': []})
+        return jsonify({'files': [], 'deleted': [], 'generation': 0, 'total': 0, 'next_offset': None})
+
+    manifest = manifest_store.get(plant_name)
+    since = request.args.get('since', type=int)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 500, type=int), 1), 5000)
+
+    # A delta query only returns what changed after the given generation
+    reset = since is not None and since < manifest.get('oldest_generation', 0)
+    if since is None or reset:
+        paths = sorted(manifest['files'])
+        deleted = []
+    else:
+        paths = sorted(p for p, e in manifest['files'].items() if e['generation'] > since)
+        deleted = sorted(p for p, g in manifest['deleted'].items() if g > since)
 
-    files = []
-    for item in os.listdir(plant_path):
-        if item == 'user.json':  # Skip user.json
-            continue
-        item_path = os.path.join(plant_path, item)
-        files.append({
-            'name': item,
-            'type': 'folder' if os.path.isdir(item_path) else 'file'
-        })
+    files = [file_listing_entry(path, manifest['files'][path]) for path in paths[offset:offset + limit]]
 
-    return jsonify({'files': files})
+    return jsonify({
+        'files': files,
+        'deleted': deleted if offset == 0 else [],
+        'generation': manifest['generation'],
+        'reset': reset,
+        'total': len(paths),
+        'next_offset': offset + limit if offset + limit < len(paths) else None,
+    })
 
-@app.route('/api/delete/<plant_name>/<filename>', methods=['DELETE'])
+@app.route('/api/delete/<plant_name>/<path:filename>', methods=['DELETE'])
 def delete_file(plant_name, filename):
     if 'username' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -231,18 +2741,381 @@ def delete_file(plant_name, filename):
     if filename == 'user.json':
         return jsonify({'error': 'Cannot delete user.json! 🌱'}), 403
 
-    plant_path = os.path.join(PLANTS_DIR, plant_name)
-    file_path = os.path.join(plant_path, filename)
+    plant_path = plant_dir(plant_name)
+    file_path = safe_join(plant_path, filename)
+    if file_path is None or is_internal_path(filename):
+        return jsonify({'error': 'Could not delete file'}), 400
 
+    # The file is renamed to a tombstone right away and removed by a background job
+    if job_queue.busy():
+        return busy_response()
     try:
-        if os.path.isdir(file_path):
-            shutil.rmtree(file_path)
-        else:
-            os.remove(file_path)
-        return jsonify({'success': True, 'message': f'{filename} deleted with love! 🌱'})
-    except:
+        path = filename.strip('/')
+        with manifest_store.writing(plant_name):
+            if not os.path.isdir(file_path):
+                remove_compressed_variants(file_path)
+            job = trash(plant_name, path, owner=session['username'])
+            manifest_store.remove(plant_name, path)
+        return jsonify({'success': True, 'job_id': job['id'], 'message': f'{filename} deleted with love! 🌱'})
+    except OSError:
         return jsonify({'error': 'Could not delete file'}), 500
 
+def sync_state_path(plant_name, sync_id):
+    return os.path.join(plant_dir(plant_name), f'.sync-{sync_id}', 'state.json')
+
+def load_sync_state(plant_name, sync_id):
+    if not all(c in '0123456789abcdef' for c in sync_id):
+        return None
+    try:
+        with open(sync_state_path(plant_name, sync_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_sync_state(plant_name, sync_id, state):
+    path = sync_state_path(plant_name, sync_id)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+def clean_sync_path(path):
+    """Normalize a path from a sync manifest, None if it isn't allowed"""
+    parts = [p for p in str(path).replace('\\', '/').split('/') if p not in ('', '.')]
+    if not parts or parts == ['user.json'] or any(p == '..' or p.startswith('.') for p in parts):
+        return None
+    return '/'.join(parts)
+
+@app.route('/api/sync/<plant_name>', methods=['POST'])
+def start_sync(plant_name):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    wanted = {}
+    for item in (request.get_json() or {}).get('files', []):
+        path = clean_sync_path(item.get('path', ''))
+        if path is None or not isinstance(item.get('hash'), str) or not isinstance(item.get('size'), int):
+            return jsonify({'error': f'Invalid manifest entry {item.get("path")!r}'}), 400
+        wanted[path] = {'hash': item['hash'].lower(), 'size': item['size']}
+
+    # Compare against what the plant already has
+    current = manifest_store.get(plant_name)['files']
+    needed = {p: w for p, w in wanted.items() if p not in current or current[p]['sha256'] != w['hash']}
+    delete = sorted(p for p in current if p not in wanted)
+
+    # The plant ends up holding exactly the wanted files, any growth is held until commit
+    sync_id = uuid.uuid4().hex
+    wanted_size = sum(w['size'] for w in wanted.values())
+    current_size = sum(e['size'] for e in current.values())
+    growth = (max(wanted_size - current_size, 0), max(len(wanted) - len(current), 0))
+    error = quota_reserve(f'sync-{sync_id}', plant_name, f'.sync-{sync_id}', growth, size=wanted_size,
+                          files=len(wanted), freed_size=current_size, freed_files=len(current))
+    if error:
+        return quota_response(error)
+
+    with manifest_store.writing(plant_name):
+        os.makedirs(os.path.join(plant_dir(plant_name), f'.sync-{sync_id}', 'incoming'))
+        save_sync_state(plant_name, sync_id, {'needed': needed, 'delete': delete, 'received': []})
+    return jsonify({'sync_id': sync_id, 'needed': sorted(needed), 'delete': delete})
+
+@app.route('/api/sync/<plant_name>/<sync_id>/files/<path:path>', methods=['PUT'])
+def sync_upload(plant_name, sync_id, path):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    state = load_sync_state(plant_name, sync_id)
+    if state is None:
+        return jsonify({'error': 'Sync not found'}), 404
+    path = clean_sync_path(path)
+    if path not in state['needed']:
+        return jsonify({'error': 'This file is not needed'}), 400
+
+    # Stream the body into the staging tree, hashing as we go
+    with manifest_store.writing(plant_name):
+        target = os.path.join(plant_dir(plant_name), f'.sync-{sync_id}', 'incoming', path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        digest = hashlib.sha256()
+        declared = state['needed'][path]['size']
+        written = 0
+        with open(target + '.part', 'wb') as f:
+            for block in iter(lambda: request.stream.read(1024 * 1024), b''):
+                written += len(block)
+                if written > declared:
+                    break
+                digest.update(block)
+                f.write(block)
+        if written > declared:
+            os.remove(target + '.part')
+            return jsonify({'error': f'{path} is bigger than the {declared} bytes declared 💔'}), 413
+        if digest.hexdigest() != state['needed'][path]['hash']:
+            os.remove(target + '.part')
+            return jsonify({'error': f'Checksum mismatch for {path} 💔'}), 422
+        os.replace(target + '.part', target)
+
+        with upload_state_lock:
+            state = load_sync_state(plant_name, sync_id)
+            if path not in state['received']:
+                state['received'].append(path)
+                save_sync_state(plant_name, sync_id, state)
+
+    return jsonify({'success': True, 'remaining': len(state['needed']) - len(state['received'])})
+
+@app.route('/api/sync/<plant_name>/<sync_id>', methods=['DELETE'])
+def abort_sync(plant_name, sync_id):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    if load_sync_state(plant_name, sync_id) is None:
+        return jsonify({'error': 'Sync not found'}), 404
+
+    # Throw the received files away and give the held quota back
+    with manifest_store.writing(plant_name):
+        remove_staging(plant_name, f'.sync-{sync_id}')
+    plant_catalog.release(f'sync-{sync_id}')
+    return jsonify({'success': True, 'message': 'Sync cancelled 🌱'})
+
+@app.route('/api/sync/<plant_name>/<sync_id>/commit', methods=['POST'])
+def commit_sync(plant_name, sync_id):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    state = load_sync_state(plant_name, sync_id)
+    if state is None:
+        return jsonify({'error': 'Sync not found'}), 404
+    missing = sorted(set(state['needed']) - set(state['received']))
+    if missing:
+        return jsonify({'error': 'Sync is not complete', 'missing': missing}), 409
+
+    plant_path = plant_dir(plant_name)
+    sync_path = os.path.join(plant_path, f'.sync-{sync_id}')
+    incoming = os.path.join(sync_path, 'incoming')
+    new_tree = os.path.join(os.path.dirname(plant_path), f'.sync-{sync_id}-{plant_name}')
+    replaced = set(state['needed']) | set(state['delete'])
+
+    # Nothing else may write into the plant from the walk until the new manifest is in place
+    with manifest_store.swapping(plant_name):
+        # The same sync may have been committed while this request waited
+        if load_sync_state(plant_name, sync_id) is None:
+            return jsonify({'error': 'Sync not found'}), 404
+
+        # Check the quota again with the bytes that really arrived
+        current = manifest_store.get(plant_name)['files']
+        kept = [e['size'] for p, e in current.items() if p not in replaced]
+        arrived = [os.path.getsize(os.path.join(incoming, p)) for p in state['needed']]
+        error = quota_error(plant_name, sum(kept) + sum(arrived), len(kept) + len(arrived),
+                            freed_size=sum(e['size'] for e in current.values()), freed_files=len(current),
+                            exclude=f'sync-{sync_id}')
+        if error:
+            return quota_response(error)
+
+        # Build the new tree next to the plant: unchanged files are hardlinked, new ones moved in.
+        # Other syncs' staging folders come along so they can still finish.
+        skipped = (f'.sync-{sync_id}', '.trash-', '.extract-')
+        for dirpath, dirnames, filenames in os.walk(plant_path):
+            rel = os.path.relpath(dirpath, plant_path)
+            rel = '' if rel == '.' else rel.replace(os.sep, '/')
+            dirnames[:] = [d for d in dirnames if not (rel == '' and d.startswith(skipped))]
+            os.makedirs(os.path.join(new_tree, rel), exist_ok=True)
+            for name in filenames:
+                path = f'{rel}/{name}' if rel else name
+                base, suffix = os.path.splitext(path)
+                if path in replaced or (suffix in COMPRESSED_SUFFIXES.values() and base in replaced):
+                    continue
+                os.link(os.path.join(dirpath, name), os.path.join(new_tree, path))
+        for path in state['needed']:
+            target = os.path.join(new_tree, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(os.path.join(incoming, path), target)
+            if DEDUPLICATE_UPLOADS:
+                blob_store.adopt(target)
+            write_compressed_variants(target)
+
+        # Swap the trees in one step, then throw the old one away in the background. The old tree
+        # still links the replaced files' blobs, so the purge job frees them once it is gone
+        digests = [current[p]['sha256'] for p in sorted(replaced) if p in current]
+        try:
+            exchange_paths(plant_path, new_tree)
+        except OSError:
+            # Hand the arrived files back, so the commit can be tried again
+            for path in state['needed']:
+                os.rename(os.path.join(new_tree, path), os.path.join(incoming, path))
+            shutil.rmtree(new_tree, ignore_errors=True)
+            return jsonify({'error': 'Could not swap in the synced files, please try again later 💔'}), 500
+        trash_name = f'.trash-{uuid.uuid4().hex}'
+        os.rename(new_tree, os.path.join(plant_path, trash_name))
+        job_queue.submit('purge', owner=session['username'], plant_name=plant_name, trash_name=trash_name,
+                         digests=digests)
+
+        manifest_store.apply(plant_name, changed=sorted(state['needed']), removed=state['delete'])
+    plant_catalog.release(f'sync-{sync_id}')
+    return jsonify({'success': True, 'message': f'{plant_name} synced with love! 🌱',
+                    'uploaded': len(state['needed']), 'deleted': len(state['delete'])})
+
+def manifest_delta(plant_name, since):
+    """A change event built from the manifest for everything after a generation, None if nothing changed"""
+    manifest = manifest_store.get(plant_name)
+    if manifest['generation'] <= since:
+        return None
+    if since < manifest.get('oldest_generation', 0):
+        return {'reset': True}
+    return {
+        'generation': manifest['generation'],
+        'added': [],
+        'modified': [file_listing_entry(p, e) for p, e in sorted(manifest['files'].items()) if e['generation'] > since],
+        'removed': sorted(p for p, g in manifest['deleted'].items() if g > since),
+    }
+
+@app.route('/api/events/<plant_name>')
+def plant_event_stream(plant_name):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Check if user is owner
+    if get_plant_owner(plant_name) != session['username']:
+        return jsonify({'error': 'You are not the owner of this plant! 🌸'}), 403
+
+    events = plant_events.subscribe(plant_name, session['username'])
+    if events is None:
+        response = jsonify({'error': 'Too many live views open, please close a tab or two! 🌸'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(EVENTS_HEARTBEAT)
+        return response
+    last_id = request.headers.get('Last-Event-ID', type=int)
+
+    def stream():
+        # A reconnecting client first gets whatever it missed
+        sent = manifest_store.get(plant_name)['generation']
+        if last_id is not None and last_id < sent:
+            yield f"event: reset\ndata: {json.dumps({'generation': sent})}\n\n"
+        idle = 0
+        while True:
+            try:
+                event = events.get(timeout=EVENTS_POLL)
+            except queue.Empty:
+                # Changes made by other worker processes only show up in the manifest
+                event = manifest_delta(plant_name, sent)
+                if event is None:
+                    idle += EVENTS_POLL
+                    if idle >= EVENTS_HEARTBEAT:
+                        idle = 0
+                        yield ': keep-alive\n\n'
+                    continue
+            if event.get('reset'):
+                yield 'event: reset\ndata: {}\n\n'
+                return
+            if event['generation'] <= sent:
+                continue
+            idle = 0
+            sent = event['generation']
+            yield f"id: {event['generation']}\nevent: change\ndata: {json.dumps(event)}\n\n"
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Frees the stream's slot even when the client leaves before the first event
+    response.call_on_close(lambda: plant_events.unsubscribe(plant_name, events))
+    return response
+
+def plant_listing(owner=None):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    sort = request.args.get('sort', 'recent')
+    if sort not in PlantCatalog.SORTS:
+        return jsonify({'error': f'Sort by one of: {", ".join(PlantCatalog.SORTS)} 🌱'}), 400
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+
+    total, plants = plant_catalog.list(owner=owner, sort=sort, offset=offset, limit=limit)
+    return jsonify({
+        'plants': plants,
+        'total': total,
+        'next_offset': offset + limit if offset + limit < total else None,
+    })
+
+@app.route('/api/plants')
+def list_plants():
+    return plant_listing()
+
+@app.route('/api/users/<username>/plants')
+def list_user_plants(username):
+    return plant_listing(owner=username)
+
+@app.route('/api/admin/reconcile-usage', methods=['POST'])
+def reconcile_usage():
+    if session.get('username') not in ADMIN_USERS:
+        return jsonify({'error': 'Only admins can reconcile usage! 🌸'}), 403
+    if job_queue.busy():
+        return busy_response()
+
+    job = job_queue.submit('reconcile_usage', owner=session['username'])
+    return jsonify({'success': True, 'job_id': job['id'], 'message': 'Reconciling usage in the background 🌱'})
+
+@app.route('/api/search')
+def search():
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Tell us what to look for! 🔍'}), 400
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+
+    total, results = search_index.search(query, offset, limit)
+    return jsonify({
+        'query': query,
+        'results': results,
+        'total': total,
+        'next_offset': offset + limit if offset + limit < total else None,
+    })
+
+@app.route('/api/admin/profiling', methods=['GET', 'POST'])
+def profiling_settings():
+    if session.get('username') not in ADMIN_USERS:
+        return jsonify({'error': 'Only admins can change profiling! 🌸'}), 403
+
+    # Settings live in a file, so every worker profiles alike and any of them can answer
+    profiler.refresh()
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        profiler.configure(max(int(data.get('sample_rate', profiler.sample_rate)), 0),
+                           float(data.get('slow_seconds', profiler.slow_seconds)))
+
+    return jsonify({'sample_rate': profiler.sample_rate, 'slow_seconds': profiler.slow_seconds})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Cache hits and misses are counters summed over all workers, the size is this worker's own
+    gauges = [('plant_viewer_cache_size', len(viewer_cache))]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    job = job_queue.get(job_id)
+    if job is None or job.get('owner') != session['username']:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify({key: job.get(key) for key in ('id', 'kind', 'status', 'result', 'error', 'created', 'updated')})
+
 # HTML Templates with love
 AUTH_TEMPLATE = '''
 <!DOCTYPE html>
@@ -545,7 +3418,11 @@ PLANT_VIEWER_TEMPLATE = '''
 </head>
 <body>
     <!-- Plant content in iframe -->
+    {% if content_url %}
+    <iframe id="plantFrame" src="{{ content_url }}"></iframe>
+    {% else %}
     <iframe id="plantFrame" srcdoc="{{ content|e }}"></iframe>
+    {% endif %}
 
     {% if is_owner %}
     <!-- Plant Manager Window -->
@@ -626,28 +3503,43 @@ PLANT_VIEWER_TEMPLATE = '''
         });
 
         async function handleFiles(files) {
-            for (let file of files) {
-                await uploadFile(file);
+            // Send files in batches instead of one request per file
+            const batchSize = 100;
+            files = Array.from(files);
+            for (let i = 0; i < files.length; i += batchSize) {
+                await uploadBatch(files.slice(i, i + batchSize));
+            }
+            // With live updates the list and preview are patched by change events
+            if (!liveUpdates) {
+                await loadFiles();
+                reloadPlant();
             }
-            loadFiles();
-            setTimeout(() => {
-                document.getElementById('plantFrame').src = document.getElementById('plantFrame').src;
-            }, 1000);
         }
 
-        async function uploadFile(file) {
+        async function uploadBatch(files) {
             const formData = new FormData();
-            formData.append('file', file);
+            files.forEach(file => formData.append('files', file));
 
             try {
-                const response = await fetch(`/api/upload/{{ plant_name }}`, {
+                const response = await fetch(`/api/upload/{{ plant_name }}/batch`, {
                     method: 'POST',
                     body: formData
                 });
 
                 const result = await response.json();
-                if (result.success) {
-                    console.log(result.message);
+                if (result.results) {
+                    for (const r of result.results) {
+                        if (r.job_id) {
+                            await waitForJob(r.job_id, r);
+                        }
+                        if (r.success) {
+                            console.log(r.message);
+                        }
+                    }
+                    const failed = result.results.filter(r => !r.success);
+                    if (failed.length) {
+                        alert(failed.map(r => `${r.name}: ${r.error}`).join('\\n'));
+                    }
                 } else {
                     alert(result.error);
                 }
@@ -656,42 +3548,101 @@ PLANT_VIEWER_TEMPLATE = '''
             }
         }
 
+        // Wait for a background job (like a big zip extraction) and copy its outcome into result
+        async function waitForJob(jobId, result) {
+            while (true) {
+                const response = await fetch(`/api/jobs/${jobId}`);
+                const job = await response.json();
+                if (job.status === 'done') {
+                    result.success = true;
+                    result.message = job.result && job.result.message;
+                    return;
+                }
+                if (job.status === 'failed' || job.error) {
+                    result.success = false;
+                    result.error = job.error;
+                    return;
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000));
+            }
+        }
+
+        // Files we know about (path -> entry) and the manifest generation they came from
+        const knownFiles = new Map();
+        let filesGeneration = null;
+
         async function loadFiles() {
             try {
-                const response = await fetch(`/api/files/{{ plant_name }}`);
-                const data = await response.json();
-
-                const filesList = document.getElementById('filesList');
-                filesList.innerHTML = '';
-
-                data.files.forEach(file => {
-                    const fileItem = document.createElement('div');
-                    fileItem.className = `file-item ${file.type}`;
-                    fileItem.innerHTML = `
-                        <span>${file.type === 'folder' ? '📁' : '📄'} ${file.name}</span>
-                        <button class="delete-btn" onclick="deleteFile('${file.name}')">🗑️</button>
-                    `;
-                    filesList.appendChild(fileItem);
-                });
+                // After the first load only ask for what changed
+                let offset = 0;
+                const since = filesGeneration;
+                do {
+                    const query = since === null ? `offset=${offset}` : `since=${since}&offset=${offset}`;
+                    const response = await fetch(`/api/files/{{ plant_name }}?${query}`);
+                    const data = await response.json();
+
+                    if (offset === 0 && (since === null || data.reset)) knownFiles.clear();
+                    data.deleted.forEach(path => knownFiles.delete(path));
+                    data.files.forEach(file => knownFiles.set(file.path, file));
+                    filesGeneration = data.generation;
+                    offset = data.next_offset;
+                } while (offset !== null);
+
+                renderFiles();
             } catch (error) {
                 console.error('Failed to load files');
             }
         }
 
+        function renderFiles() {
+            // Folders are implied by the file paths
+            const entries = new Map();
+            knownFiles.forEach((file, path) => {
+                const parts = path.split('/');
+                for (let i = 1; i < parts.length; i++) {
+                    const folder = parts.slice(0, i).join('/');
+                    entries.set(folder, { path: folder, name: parts[i - 1], type: 'folder' });
+                }
+                entries.set(path, file);
+            });
+
+            const filesList = document.getElementById('filesList');
+            filesList.innerHTML = '';
+
+            Array.from(entries.keys()).sort().forEach(path => {
+                const file = entries.get(path);
+                const fileItem = document.createElement('div');
+                fileItem.className = `file-item ${file.type}`;
+                fileItem.style.marginLeft = `${(path.split('/').length - 1) * 12}px`;
+
+                const label = document.createElement('span');
+                label.textContent = `${file.type === 'folder' ? '📁' : '📄'} ${file.name}`;
+                const deleteBtn = document.createElement('button');
+                deleteBtn.className = 'delete-btn';
+                deleteBtn.textContent = '🗑️';
+                deleteBtn.onclick = () => deleteFile(path);
+
+                fileItem.appendChild(label);
+                fileItem.appendChild(deleteBtn);
+                filesList.appendChild(fileItem);
+            });
+        }
+
         async function deleteFile(filename) {
             if (!confirm(`Are you sure you want to delete ${filename}?`)) return;
 
             try {
-                const response = await fetch(`/api/delete/{{ plant_name }}/${filename}`, {
+                const encoded = filename.split('/').map(encodeURIComponent).join('/');
+                const response = await fetch(`/api/delete/{{ plant_name }}/${encoded}`, {
                     method: 'DELETE'
                 });
 
                 const result = await response.json();
                 if (result.success) {
-                    loadFiles();
-                    setTimeout(() => {
-                        document.getElementById('plantFrame').src = document.getElementById('plantFrame').src;
-                    }, 1000);
+                    if (!liveUpdates) {
+                        await loadFiles();
+                        reloadPlant();
+                    }
                 } else {
                     alert(result.error);
                 }
@@ -700,6 +3651,53 @@ PLANT_VIEWER_TEMPLATE = '''
             }
         }
 
+        // Reload the preview, fetching index.html again when it is inlined with srcdoc
+        async function reloadPlant() {
+            const frame = document.getElementById('plantFrame');
+            if (frame.hasAttribute('srcdoc')) {
+                const response = await fetch(`/{{ plant_name }}/index.html`, { cache: 'no-cache' });
+                frame.srcdoc = await response.text();
+            } else {
+                frame.src = frame.src;
+            }
+        }
+
+        // Live updates: patch the file list from change events, reload the preview only for page assets
+        const pageAssets = /\\.(html?|css|m?js|json|svg|png|jpe?g|gif|webp|ico|woff2?|ttf|otf)$/i;
+        let liveUpdates = false;
+
+        function listenForChanges() {
+            const events = new EventSource(`/api/events/{{ plant_name }}`);
+            events.onopen = () => { liveUpdates = true; };
+            events.onerror = () => {
+                liveUpdates = false;
+                // Refused streams (too many tabs open) are not retried by the browser, try again later
+                if (events.readyState === EventSource.CLOSED) {
+                    setTimeout(listenForChanges, 30000);
+                }
+            };
+            events.addEventListener('change', (e) => {
+                const change = JSON.parse(e.data);
+                change.removed.forEach(path => knownFiles.delete(path));
+                change.added.concat(change.modified).forEach(file => knownFiles.set(file.path, file));
+                filesGeneration = change.generation;
+                renderFiles();
+
+                const paths = change.removed.concat(change.added.concat(change.modified).map(f => f.path));
+                if (paths.some(path => pageAssets.test(path))) {
+                    reloadPlant();
+                }
+            });
+            events.addEventListener('reset', () => {
+                loadFiles();
+                reloadPlant();
+            });
+        }
+
+        if (window.EventSource) {
+            listenForChanges();
+        }
+
         // Load files on page load
         loadFiles();
     </script>
@@ -708,5 +3706,170 @@ PLANT_VIEWER_TEMPLATE = '''
 </html>
 '''
 
+# Templates are compiled once here instead of on every request
+TEMPLATES = {
+    'auth': app.jinja_env.from_string(AUTH_TEMPLATE),
+    'welcome': app.jinja_env.from_string(WELCOME_TEMPLATE),
+    'plant_viewer': app.jinja_env.from_string(PLANT_VIEWER_TEMPLATE),
+}
+
+# Pages without any variables are rendered once and kept as bytes (plain and gzipped)
+STATIC_PAGES = {}
+for _name in ('auth',):
+    _body = TEMPLATES[_name].render().encode('utf-8')
+    STATIC_PAGES[_name] = (_body, gzip.compress(_body, compresslevel=9))
+
+def render_page(name, **context):
+    """Render a precompiled template"""
+    with metrics.timer('template_render'):
+        return TEMPLATES[name].render(**context)
+
+def static_page(name):
+    """Serve a pre-rendered page, gzipped when the client accepts it"""
+    body, gzipped = STATIC_PAGES[name]
+    response = Response(body, mimetype='text/html')
+    if 'gzip' in request.accept_encodings:
+        response.set_data(gzipped)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.cli.command('migrate-layout')
+@click.option('--flat', is_flag=True, help='Move plants back out of the sharded layout.')
+@click.option('--batch-size', default=500, show_default=True, help='Plants moved per batch.')
+@click.option('--pause', default=0.5, show_default=True, help='Seconds to wait between batches.')
+def migrate_layout_command(flat, batch_size, pause):
+    """Move plants between the flat and the sharded layout"""
+    migrate_plants(sharded=not flat, batch_size=batch_size, pause=pause, log=click.echo)
+
+@app.cli.command('search-rebuild')
+@click.option('--processes', default=None, type=int, help='Worker processes, one per CPU by default.')
+def search_rebuild_command(processes):
+    """Index the HTML and text files of every plant from scratch"""
+    search_index.rebuild(processes=processes, log=click.echo)
+
+@app.cli.command('catalog-rebuild')
+def catalog_rebuild_command():
+    """Add every existing plant to the plant catalog"""
+    plant_catalog.rebuild(log=click.echo)
+
+@app.cli.command('reconcile-usage')
+def reconcile_usage_command():
+    """Recount plant and owner usage from disk"""
+    click.echo(reconcile_usage_job()['message'])
+
+def reset_after_fork():
+    """Give a forked process its own threads, locks, database connections and subscribers
+
+    Runs after every fork, so it only resets state: a lock held by one of the
+    parent's threads at fork time would otherwise never be released. Jobs are
+    started separately by job_queue.start() in processes that serve requests.
+
+    Workers take turns on a plant's manifest and tree through flocks on the
+    files in LOCKS_DIR; the child opens its own descriptors, since one shared
+    with the parent would share the parent's locks. The plant index, manifests
+    and rendered pages are validated against file mtimes on use, and event
+    streams pick up other workers' changes from the manifest.
+    """
+    global upload_pool, upload_state_lock
+    upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    upload_state_lock = threading.Lock()
+    user_store._local = threading.local()
+    rate_limiter._local = threading.local()
+    rate_limiter._lock = threading.Lock()
+    plant_catalog._local = threading.local()
+    search_index._local = threading.local()
+    for pool in (password_pool, extraction_pool):
+        pool._pool = ThreadPoolExecutor(max_workers=pool.workers)
+        pool._slots = threading.BoundedSemaphore(pool.workers + pool.max_queue)
+    plant_index._lock = threading.Lock()
+    viewer_cache._lock = threading.Lock()
+    manifest_store._lock = threading.Lock()
+    for lock in manifest_store._locks.values():
+        lock.close()
+    manifest_store._locks = {}
+    manifest_store._write_locks = {}
+    blob_store._lock = threading.Lock()
+    job_queue.token = f'{os.getpid()}:{uuid.uuid4().hex}'
+    job_queue._pool = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+    job_queue._pending = 0
+    job_queue._pending_lock = threading.Lock()
+    plant_events._subscribers = {}
+    plant_events._users = {}
+    plant_events._lock = threading.Lock()
+    profiler.sampler._threads = {}
+    profiler.sampler._lock = threading.Lock()
+    profiler._cprofile_lock = threading.Lock()
+    metrics.counters = {}
+    metrics.histograms = {}
+    metrics._lock = threading.Lock()
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+@app.cli.command('serve')
+@click.option('--bind', default='127.0.0.1:5000', show_default=True, envvar='PLANT_BIND', help='Address to listen on.')
+@click.option('--workers', default=(os.cpu_count() or 1) * 2 + 1, show_default=True, envvar='PLANT_WORKERS',
+              help='Worker processes.')
+@click.option('--threads', default=16, show_default=True, envvar='PLANT_THREADS',
+              help='Threads per worker, open event streams hold up to EVENTS_MAX_STREAMS of them.')
+@click.option('--timeout', default=120, show_default=True, help='Seconds before a stuck worker is restarted.')
+def serve_command(bind, workers, threads, timeout):
+    """Run Plant with gunicorn, the app is loaded once and forked into the workers"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise click.ClickException('The production server needs gunicorn: pip install gunicorn')
+
+    options = {
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'timeout': timeout,
+        'preload_app': True,
+        'post_fork': lambda server, worker: job_queue.start(),
+    }
+
+    class PlantServer(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    PlantServer().run()
+
+@app.cli.command('profile-report')
+@click.option('--top', default=20, show_default=True, help='How many functions to show.')
+@click.option('--endpoint', default=None, help='Only profiles of this endpoint.')
+@click.option('--plant', default=None, help='Only profiles of this plant.')
+def profile_report_command(top, endpoint, plant):
+    """Show the hottest functions across saved request profiles"""
+    if not os.path.isdir(PROFILE_DIR):
+        raise click.ClickException(f'No profiles in {PROFILE_DIR} yet')
+    paths = []
+    for name in sorted(os.listdir(PROFILE_DIR)):
+        tag = name.split('-', 1)[-1]
+        if endpoint and not tag.startswith(secure_filename(endpoint) + '-'):
+            continue
+        if plant and f'-{secure_filename(plant)}-' not in tag:
+            continue
+        paths.append(os.path.join(PROFILE_DIR, name))
+
+    cprofile_rows, sampled_rows = profile_report(paths, top)
+    click.echo(f'{len(paths)} profiles')
+    if cprofile_rows:
+        click.echo('\ncProfile, by own time:')
+        click.echo(f'{"own s":>10} {"cum s":>10} {"calls":>10}  function')
+        for func, calls, own, cumulative in cprofile_rows:
+            click.echo(f'{own:10.4f} {cumulative:10.4f} {calls:10d}  {func}')
+    if sampled_rows:
+        click.echo('\nSlow requests, by samples on top of the stack:')
+        for func, count, share in sampled_rows:
+            click.echo(f'{count:10d} {share:6.1%}  {func}')
+
 if __name__ == '__main__':
-    app.run(debug=True, host='127.0.0.1', port=5000)
+    # Development server only, use `flask --app main serve` in production
+    job_queue.start()
+    app.run(debug=os.environ.get('PLANT_DEBUG') == '1', host='127.0.0.1', port=5000)
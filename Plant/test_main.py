@@ -0,0 +1,340 @@
+"""Regression tests for Plant, run with `python -m pytest` from this directory"""
+import importlib
+import io
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+import threading
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture
+def plant(tmp_path, monkeypatch):
+    """A fresh copy of the app working in an empty directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PLANT_RATE_LIMITS', '0')
+    monkeypatch.syspath_prepend(HERE)
+    sys.modules.pop('main', None)
+    main = importlib.import_module('main')
+    # The metrics dumper thread outlives the test, keep it writing into tmp_path
+    main.METRICS_DIR = str(tmp_path / 'metrics')
+    yield main
+    sys.modules.pop('main', None)
+
+@pytest.fixture
+def client(plant):
+    client = plant.app.test_client()
+    client.post('/register', json={'username': 'ann', 'password': 'love', 'repeat_password': 'love'})
+    client.get('/garden')
+    return client
+
+def zip_of(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+@pytest.mark.parametrize('members, limits, message', [
+    ({'../evil.txt': b'x'}, {}, 'outside the folder'),
+    ({'bomb.txt': b'0' * (20 * 1024 * 1024)}, {}, 'compressed suspiciously well'),
+    ({'a.txt': b'a', 'b.txt': b'b', 'c.txt': b'c'}, {'ZIP_MAX_FILES': 2}, 'Too many files'),
+    ({'big.txt': b'x' * 200}, {'ZIP_MAX_TOTAL_SIZE': 100}, 'more than 100 bytes'),
+])
+def test_extract_zip_enforces_its_limits(plant, tmp_path, monkeypatch, members, limits, message):
+    for name, value in limits.items():
+        monkeypatch.setattr(plant, name, value)
+    with pytest.raises(plant.ExtractionError, match=message):
+        plant.extract_zip(zip_of(members), str(tmp_path / 'out'))
+
+def test_failed_extraction_leaves_nothing_behind(plant, client):
+    archive = zip_of({'ok.txt': b'fine', '../evil.txt': b'x'})
+    response = client.post('/api/upload/garden', data={'file': (archive, 'site.zip')})
+    assert response.status_code == 400
+    assert 'outside the folder' in response.json['error']
+    names = os.listdir(plant.plant_dir('garden'))
+    assert 'site' not in names
+    assert not [n for n in names if n.startswith('.extract-')]
+
+    response = client.post('/api/upload/garden', data={'file': (zip_of({'ok.txt': b'fine'}), 'site.zip')})
+    assert response.status_code == 200
+    assert client.get('/garden/site/ok.txt').data == b'fine'
+
+def test_legacy_password_is_upgraded_at_login(plant):
+    client = plant.app.test_client()
+    legacy = plant.hashlib.sha256(b'old love').hexdigest()
+    plant.user_store.put('bob', {'password': legacy, 'created': '2024-01-01T00:00:00'})
+
+    assert client.post('/login', json={'username': 'bob', 'password': 'old love'}).status_code == 200
+    assert plant.get_user('bob')['password'].startswith('scrypt$')
+    assert client.post('/login', json={'username': 'bob', 'password': 'wrong'}).status_code == 400
+    assert client.post('/login', json={'username': 'bob', 'password': 'old love'}).status_code == 200
+
+def test_login_is_refused_while_password_pool_is_full(plant, client):
+    pool = plant.password_pool
+    for _ in range(pool.workers + pool.max_queue):
+        pool._slots.acquire()
+    try:
+        response = client.post('/login', json={'username': 'ann', 'password': 'love'})
+    finally:
+        for _ in range(pool.workers + pool.max_queue):
+            pool._slots.release()
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+    assert client.post('/login', json={'username': 'ann', 'password': 'love'}).status_code == 200
+
+def test_batch_upload_saves_every_file(plant, client):
+    generation = plant.manifest_store.get('garden')['generation']
+    files = [(io.BytesIO(f'file {i}'.encode()), f'f{i}.txt') for i in range(60)]
+    response = client.post('/api/upload/garden/batch', data={'files': files})
+    assert response.status_code == 200
+    assert response.json['success']
+    listing = client.get('/api/files/garden?limit=100').json
+    assert listing['generation'] == generation + 1
+    assert sorted(f['path'] for f in listing['files']) == sorted(f'f{i}.txt' for i in range(60))
+    assert plant.plant_catalog.usage('garden')[1] == 60
+
+def test_rate_limits_key_on_the_forwarded_address(plant, tmp_path, monkeypatch):
+    monkeypatch.setenv('PLANT_RATE_LIMITS', '1')
+    monkeypatch.setenv('PLANT_TRUSTED_PROXIES', '1')
+    plant = importlib.reload(plant)
+    plant.METRICS_DIR = str(tmp_path / 'metrics')
+    client = plant.app.test_client()
+    login = {'username': 'ann', 'password': 'wrong'}
+    requests_allowed = plant.RATE_LIMITS['login'][0]
+    for _ in range(requests_allowed):
+        assert client.post('/login', json=login, headers={'X-Forwarded-For': '10.0.0.1'}).status_code != 429
+    assert client.post('/login', json=login, headers={'X-Forwarded-For': '10.0.0.1'}).status_code == 429
+    assert client.post('/login', json=login, headers={'X-Forwarded-For': '10.0.0.2'}).status_code != 429
+
+def test_viewer_cache_hits_and_misses_are_counters(plant, client):
+    client.get('/garden')
+    lines = client.get('/metrics').get_data(as_text=True).splitlines()
+    assert 'plant_viewer_cache_misses_total 1' in lines
+    assert 'plant_viewer_cache_hits_total 1' in lines
+    assert '# TYPE plant_viewer_cache_hits_total counter' in lines
+
+def test_shared_rate_limit_buckets_are_swept_once_refilled(plant, tmp_path):
+    limiter = plant.RateLimiter({'login': (2, 60)}, str(tmp_path / 'limits.db'))
+    for client in range(50):
+        limiter._take(f'login:ip:{client}', 2, 2 / 60, 1000)
+    assert limiter._take('login:ip:0', 2, 2 / 60, 1000) == 0
+    assert limiter._take('login:ip:0', 2, 2 / 60, 1000) > 0
+
+    limiter._take('login:ip:new', 2, 2 / 60, 1100)
+    keys = [row[0] for row in limiter._connect().execute('SELECT key FROM buckets')]
+    assert keys == ['login:ip:new']
+
+def test_sync_rejects_more_bytes_than_declared(plant, client):
+    plant.QUOTA_PLANT_BYTES = 1000
+    body = b'x' * 50000
+    digest = plant.hashlib.sha256(body).hexdigest()
+    sync = client.post('/api/sync/garden', json={'files': [{'path': 'big.bin', 'hash': digest, 'size': 0}]}).json
+    response = client.put(f'/api/sync/garden/{sync["sync_id"]}/files/big.bin', data=body)
+    assert response.status_code == 413
+    assert client.post(f'/api/sync/garden/{sync["sync_id"]}/commit').status_code == 409
+    assert plant.plant_catalog.usage('garden', reserved=False)[2] == 0
+
+def test_sync_commit_waits_for_writes_in_flight(plant, client):
+    body = b'synced'
+    files = [{'path': 'a.txt', 'hash': plant.hashlib.sha256(body).hexdigest(), 'size': len(body)}]
+    sync = client.post('/api/sync/garden', json={'files': files}).json
+    client.put(f'/api/sync/garden/{sync["sync_id"]}/files/a.txt', data=body)
+
+    results = []
+    commit = threading.Thread(target=lambda: results.append(client.post(f'/api/sync/garden/{sync["sync_id"]}/commit')))
+    with plant.manifest_store.writing('garden'):
+        commit.start()
+        commit.join(0.2)
+        assert commit.is_alive()
+        with open(os.path.join(plant.plant_dir('garden'), 'late.txt'), 'w') as f:
+            f.write('late')
+        plant.manifest_store.update('garden', 'late.txt')
+    commit.join()
+    assert results[0].status_code == 200
+    listing = client.get('/api/files/garden').json
+    assert sorted(f['path'] for f in listing['files']) == ['a.txt', 'late.txt']
+
+def test_sync_commit_fails_cleanly_without_renameat2(plant, client, monkeypatch):
+    client.post('/api/upload/garden', data={'file': (io.BytesIO(b'old'), 'a.txt')})
+    files = [{'path': 'b.txt', 'hash': plant.hashlib.sha256(b'new').hexdigest(), 'size': 3}]
+    sync = client.post('/api/sync/garden', json={'files': files}).json
+    client.put(f'/api/sync/garden/{sync["sync_id"]}/files/b.txt', data=b'new')
+
+    libc = plant.libc
+    monkeypatch.setattr(plant, 'libc', None)
+    assert client.post(f'/api/sync/garden/{sync["sync_id"]}/commit').status_code == 500
+    assert sorted(os.listdir(os.path.dirname(plant.plant_dir('garden')))) == ['garden']
+    assert client.get('/garden/a.txt').data == b'old'
+
+    monkeypatch.setattr(plant, 'libc', libc)
+    assert client.post(f'/api/sync/garden/{sync["sync_id"]}/commit').status_code == 200
+    assert client.get('/garden/b.txt').data == b'new'
+
+def test_sync_frees_the_blobs_of_deleted_files(plant, client):
+    plant.DEDUPLICATE_UPLOADS = True
+    client.post('/api/upload/garden', data={'file': (io.BytesIO(b'only here'), 'a.txt')})
+    blob = plant.blob_store.blob_path(plant.hashlib.sha256(b'only here').hexdigest())
+    assert os.path.exists(blob)
+
+    # Under load the purge job runs after the manifest is updated
+    purge = plant.job_queue.handlers['purge']
+    plant.job_queue.handlers['purge'] = lambda **args: time.sleep(0.3) or purge(**args)
+
+    sync = client.post('/api/sync/garden', json={'files': []}).json
+    assert sync['delete'] == ['a.txt']
+    assert client.post(f'/api/sync/garden/{sync["sync_id"]}/commit').status_code == 200
+    deadline = time.time() + 5
+    while os.path.exists(blob) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not os.path.exists(blob)
+
+def test_chunked_uploads_reserve_their_declared_size(plant, client):
+    plant.QUOTA_PLANT_BYTES = 1000
+    first = client.post('/api/upload/garden/chunked', json={'filename': 'a.bin', 'size': 600})
+    assert first.status_code == 200
+    second = client.post('/api/upload/garden/chunked', json={'filename': 'b.bin', 'size': 600})
+    assert second.status_code == 413
+
+    upload_id = first.json['upload_id']
+    client.put(f'/api/upload/garden/chunked/{upload_id}?offset=0', data=b'x' * 600)
+    assert client.post(f'/api/upload/garden/chunked/{upload_id}/commit').status_code == 200
+    assert plant.plant_catalog.usage('garden')[2] == 600
+    assert client.post('/api/upload/garden/chunked', json={'filename': 'c.bin', 'size': 400}).status_code == 200
+
+def test_chunked_upload_resumes_after_missing_chunks(plant, client):
+    plant.UPLOAD_CHUNK_SIZE = 4
+    body = b'plant with love'
+    upload = client.post('/api/upload/garden/chunked', json={
+        'filename': 'poem.txt', 'size': len(body), 'sha256': plant.hashlib.sha256(body).hexdigest()}).json
+    url = f'/api/upload/garden/chunked/{upload["upload_id"]}'
+    client.put(f'{url}?offset=0', data=body[0:4])
+    client.put(f'{url}?offset=8', data=body[8:12])
+
+    # A client coming back asks what arrived and sends only the rest
+    assert client.get(url).json['received'] == [0, 2]
+    commit = client.post(f'{url}/commit')
+    assert commit.status_code == 409
+    assert commit.json['missing'] == [1, 3]
+    client.put(f'{url}?offset=4', data=body[4:8])
+    client.put(f'{url}?offset=12', data=body[12:])
+    assert client.post(f'{url}/commit').status_code == 200
+    assert client.get('/garden/poem.txt').data == body
+
+def test_chunked_upload_checksum_mismatch_is_refused(plant, client):
+    upload = client.post('/api/upload/garden/chunked', json={'filename': 'a.txt', 'size': 4}).json
+    url = f'/api/upload/garden/chunked/{upload["upload_id"]}'
+    client.put(f'{url}?offset=0', data=b'love')
+    assert client.post(f'{url}/commit', json={'sha256': plant.hashlib.sha256(b'hate').hexdigest()}).status_code == 422
+    assert client.get('/garden/a.txt').status_code == 404
+    assert client.post(f'{url}/commit', json={'sha256': plant.hashlib.sha256(b'love').hexdigest()}).status_code == 200
+
+def test_abandoned_uploads_give_their_quota_back(plant, client):
+    plant.QUOTA_PLANT_BYTES = 1000
+    upload = client.post('/api/upload/garden/chunked', json={'filename': 'a.bin', 'size': 900}).json
+    assert client.delete(f'/api/upload/garden/chunked/{upload["upload_id"]}').status_code == 200
+    assert client.get(f'/api/upload/garden/chunked/{upload["upload_id"]}').status_code == 404
+
+    sync = client.post('/api/sync/garden', json={'files': [{'path': 'a.bin', 'hash': '0' * 64, 'size': 900}]}).json
+    assert client.delete(f'/api/sync/garden/{sync["sync_id"]}').status_code == 200
+    assert client.post(f'/api/sync/garden/{sync["sync_id"]}/commit').status_code == 404
+
+    # An upload nobody finishes is cleaned up by reconcile once it is stale
+    client.post('/api/upload/garden/chunked', json={'filename': 'b.bin', 'size': 900})
+    plant.reconcile_usage_job()
+    assert client.post('/api/upload/garden/chunked', json={'filename': 'c.bin', 'size': 200}).status_code == 413
+    plant.UPLOAD_STALE_AFTER = -1
+    plant.reconcile_usage_job()
+    assert client.post('/api/upload/garden/chunked', json={'filename': 'c.bin', 'size': 200}).status_code == 200
+    staging = [n for n in os.listdir(plant.plant_dir('garden')) if n.startswith('.upload-')]
+    assert len(staging) == 2  # c.bin's file and its state, b.bin's are gone
+    assert plant.plant_catalog.usage('garden')[2] == 200
+
+def test_event_streams_are_capped_per_plant(plant, client):
+    # The test client waits for a stream's first chunk, an idle stream's first chunk is its keep-alive
+    plant.EVENTS_HEARTBEAT = 0
+    streams = [client.get('/api/events/garden', buffered=False) for _ in range(plant.EVENTS_MAX_PER_PLANT)]
+    assert all(s.status_code == 200 for s in streams)
+    refused = client.get('/api/events/garden', buffered=False)
+    assert refused.status_code == 429
+    assert refused.headers['Retry-After']
+
+    streams[0].close()
+    reopened = client.get('/api/events/garden', buffered=False)
+    assert reopened.status_code == 200
+    reopened.close()
+    for s in streams[1:]:
+        s.close()
+
+def test_manifest_updates_from_two_processes_are_all_kept(plant, client):
+    garden = plant.plant_dir('garden')
+
+    def write_files(worker):
+        for n in range(50):
+            with open(os.path.join(garden, f'w{worker}-{n}.txt'), 'w') as f:
+                f.write('love')
+            plant.manifest_store.update('garden', f'w{worker}-{n}.txt')
+
+    generation = plant.manifest_store.get('garden')['generation']
+    workers = [multiprocessing.get_context('fork').Process(target=write_files, args=(i,)) for i in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+    manifest = plant.manifest_store.get('garden')
+    assert manifest['generation'] == generation + 100
+    assert len([p for p in manifest['files'] if p.startswith('w')]) == 100
+
+def test_migrate_plants_both_ways(plant, client):
+    client.post('/api/upload/garden', data={'file': (io.BytesIO(b'<p>hi</p>'), 'index.html')})
+    client.get('/meadow')
+    quiet = dict(pause=0, log=lambda message: None)
+
+    assert plant.migrate_plants(sharded=True, **quiet) == 2
+    assert sorted(os.listdir(plant.PLANTS_DIR)) == ['.shards']
+    assert os.path.isdir(plant.sharded_plant_dir('garden'))
+    assert sorted(plant.iter_plant_names()) == ['garden', 'meadow']
+    assert client.get('/garden/index.html').data == b'<p>hi</p>'
+
+    assert plant.migrate_plants(sharded=False, **quiet) == 2
+    assert sorted(n for n in os.listdir(plant.PLANTS_DIR) if n != '.shards') == ['garden', 'meadow']
+    assert sorted(plant.iter_plant_names()) == ['garden', 'meadow']
+    assert client.get('/garden/index.html').data == b'<p>hi</p>'
+
+def test_accel_redirect_follows_the_sharded_layout(plant, client):
+    client.post('/api/upload/garden', data={'file': (io.BytesIO(b'body {}'), 'style.css')})
+    plant.SENDFILE_MODE = 'x-accel-redirect'
+    assert client.get('/garden/style.css').headers['X-Accel-Redirect'] == '/_plants/garden/style.css'
+
+    plant.migrate_plants(sharded=True, pause=0, log=lambda message: None)
+    header = client.get('/garden/style.css').headers['X-Accel-Redirect']
+    assert header.startswith('/_plants/.shards/')
+    assert os.path.isfile(os.path.join(plant.PLANTS_DIR, header[len('/_plants/'):]))
+
+def test_profiling_settings_reach_every_worker(plant, client, monkeypatch):
+    monkeypatch.setattr(plant, 'ADMIN_USERS', {'ann'})
+    assert client.post('/api/admin/profiling', json={'sample_rate': 5, 'slow_seconds': 0.5}).status_code == 200
+
+    # Another worker has its own profiler, it reads the saved settings
+    other = plant.RequestProfiler()
+    assert other.sample_rate == 0
+    other.refresh()
+    assert (other.sample_rate, other.slow_seconds) == (5, 0.5)
+
+def test_upload_puts_back_a_blob_freed_after_the_check(plant, client, monkeypatch):
+    plant.DEDUPLICATE_UPLOADS = True
+    blob = plant.blob_store.blob_path(plant.hashlib.sha256(b'shared').hexdigest())
+
+    # Another worker frees the blob right after this one saw it exists
+    exists = os.path.exists
+    monkeypatch.setattr(plant.os.path, 'exists', lambda path: path == blob or exists(path))
+    response = client.post('/api/upload/garden', data={'file': (io.BytesIO(b'shared'), 'a.txt')})
+    assert response.status_code == 200
+    assert exists(blob)
+    assert client.get('/garden/a.txt').data == b'shared'